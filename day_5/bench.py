@@ -0,0 +1,299 @@
+'''
+Benchmarks for the cover pipeline, run on synthetic tetracam images
+
+Images are generated as 6-page tifs in BANDS order, with blobs of canopy over
+soil, so nothing but numpy and the standard library is needed to run them.
+Results are saved as JSON and compared against an earlier run to flag
+regressions:
+
+python bench.py --count 24 --workers 1 2 4 --out bench
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from argparse import ArgumentParser
+from datetime import datetime
+from json import dumps, loads
+from os import cpu_count
+from pathlib import Path
+from platform import node, python_version
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from numpy import __version__ as numpy_version, clip, kron, ones, quantile, \
+    random, uint8
+from pandas import DataFrame
+
+from cover import BANDS, proc_dir, proc_img, profiling, report
+from tiff import write_pages
+
+# plots and dates used to name synthetic images
+PLOTS = ('A11', 'A12', 'A13', 'B11', 'B12', 'B13')
+DATES = ('10jul2019', '17jul2019', '24jul2019', '31jul2019')
+
+def synth(path, count=12, shape=(1024, 1280), seed=0):
+    '''write synthetic tetracam images to a directory
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        output directory, created if needed
+    count : int
+        number of images
+    shape : tuple of int
+        image dimensions
+    seed : int
+        seed for image content
+
+
+    Returns
+    -------
+    list of pathlib.Path
+    '''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = random.default_rng(seed)
+    res = []
+    for i in range(count):
+        # cycle through plots, then dates, numbering repeats as extra plots
+        plot = '{}{}'.format(PLOTS[i % len(PLOTS)], i // (len(PLOTS)
+            * len(DATES)) or '')
+        date = DATES[i // len(PLOTS) % len(DATES)]
+        bands = synth_bands(shape, rng.uniform(0.1, 0.8), rng)
+        res.append(path / '{}_{}.tif'.format(date, plot))
+        write_pages(res[-1], [bands[b] for b in BANDS])
+    return res
+
+def synth_bands(shape, cover, rng):
+    '''make one synthetic image
+
+
+    Parameters
+    ----------
+    shape : tuple of int
+        image dimensions
+    cover : float
+        fraction of the image that should be canopy
+    rng : numpy.random.Generator
+        source of randomness
+
+
+    Returns
+    -------
+    dict
+        uint8 array for each band
+    '''
+    y, x = shape
+    # coarse noise blown up to blobs about 32 pixels across
+    blobs = kron(rng.random((-(-y // 32), -(-x // 32))), ones((32, 32)))
+    blobs = blobs[:y, :x] + rng.normal(0, 0.05, shape)
+    veg = blobs > quantile(blobs, 1 - cover)
+    # plants are bright in nir and edge, dark in red, soil is flat-ish
+    means = {
+        'nir': (70, 180), 'edge': (65, 140), 'red': (75, 25),
+        'yellow': (80, 60), 'green': (70, 80), 'blue': (60, 30)}
+    res = {}
+    for band, (soil, plant) in means.items():
+        a = soil + (plant - soil) * veg + rng.normal(0, 8, shape)
+        res[band] = clip(a, 0, 255).astype(uint8)
+    return res
+
+def bench_stages(imgs, **kwargs):
+    '''time each stage of proc_img, serially
+
+
+    Parameters
+    ----------
+    imgs : iterable of pathlib.Path
+        images to process
+    **kwargs
+        passed to proc_img
+
+
+    Returns
+    -------
+    DataFrame
+        per-stage summary (see cover.report)
+    '''
+    with profiling() as records:
+        for img in imgs:
+            proc_img(img, **kwargs)
+    return report(DataFrame(records))
+
+def bench_dir(path, workers, **kwargs):
+    '''time proc_dir over a directory for several worker counts
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        image directory
+    workers : iterable of int
+        worker counts to try
+    **kwargs
+        passed to proc_dir
+
+
+    Returns
+    -------
+    dict
+        wall seconds, images per second and utilization for each worker count
+    '''
+    n = len(tuple(Path(path).iterdir()))
+    res = {}
+    for w in workers:
+        stats = {}
+        start = perf_counter()
+        proc_dir(path, nproc=w, stats=stats, **kwargs)
+        wall = perf_counter() - start
+        res[str(w)] = {'wall': wall, 'ips': n / wall,
+            'utilization': stats['utilization']}
+    return res
+
+def run(count=12, shape=(1024, 1280), workers=None, path=None, **kwargs):
+    '''run the whole suite
+
+
+    Parameters
+    ----------
+    count : int
+        number of synthetic images
+    shape : tuple of int
+        image dimensions
+    workers : iterable of int, optional
+        worker counts for directory runs, defaults to 1 and every cpu
+    path : str or pathlib.Path, optional
+        where to write images, a temporary directory by default
+    **kwargs
+        passed to proc_img
+
+
+    Returns
+    -------
+    dict
+        run metadata, milliseconds per image for each stage, and directory runs
+    '''
+    workers = workers or sorted({1, cpu_count()})
+    with TemporaryDirectory() as tmp:
+        path = Path(path or tmp)
+        imgs = synth(path, count, shape)
+        stages = bench_stages(imgs, **kwargs)
+        dirs = bench_dir(path, workers, **kwargs)
+    meta = {'time': datetime.now().isoformat(timespec='microseconds'),
+        'host': node(), 'cpus': cpu_count(), 'python': python_version(),
+        'numpy': numpy_version, 'count': count, 'shape': list(shape),
+        'params': {k: repr(v) for k, v in kwargs.items()}}
+    return {'meta': meta, 'stages': stages['ms'].to_dict(), 'dirs': dirs}
+
+def compare(new, old, tol=0.1):
+    '''find timings that got slower between two runs
+
+
+    Parameters
+    ----------
+    new, old : dict
+        results from run
+    tol : float
+        allowed slowdown, as a fraction
+
+
+    Returns
+    -------
+    list of str
+        a line for each regression
+
+
+    Raises
+    ------
+    ValueError
+        if the runs can't be compared (see comparable)
+    '''
+    if not comparable(new, old):
+        raise ValueError('runs used different machines, images or '
+            'parameters')
+    res = []
+    pairs = [('stage ' + k, v, old['stages'].get(k))
+        for k, v in new['stages'].items()]
+    pairs += [('{} workers'.format(k), v['wall'], old['dirs'].get(k, {}).get(
+        'wall')) for k, v in new['dirs'].items()]
+    for name, a, b in pairs:
+        if b and a > b * (1 + tol):
+            res.append('{}: {:.4g} -> {:.4g} ({:+.0%})'.format(name, b, a,
+                a / b - 1))
+    return res
+
+def comparable(new, old):
+    '''check whether two runs timed the same work
+
+
+    Parameters
+    ----------
+    new, old : dict
+        results from run
+
+
+    Returns
+    -------
+    bool
+        True if they ran on the same host and number of cpus, with the same
+        image count, image shape and proc_img parameters
+    '''
+    return all(new['meta'][k] == old['meta'].get(k)
+        for k in ('host', 'cpus', 'count', 'shape', 'params'))
+
+def latest(path, res):
+    '''find the most recent earlier run that can be compared with a new one
+
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        directory of JSON results
+    res : dict
+        results from run
+
+
+    Returns
+    -------
+    pathlib.Path or None
+    '''
+    runs = [(loads(p.read_text()), p) for p in path.glob('*.json')]
+    runs = [(r['meta']['time'], p) for r, p in runs if comparable(res, r)]
+    return max(runs, default=(None, None))[1]
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--count', type=int, default=12)
+    parser.add_argument('--size', type=int, nargs=2, default=(1024, 1280),
+        metavar=('ROWS', 'COLS'))
+    parser.add_argument('--workers', type=int, nargs='+')
+    parser.add_argument('--out', default='bench',
+        help='directory for JSON results')
+    parser.add_argument('--compare', help='earlier results, defaults to the '
+        'latest in --out')
+    parser.add_argument('--tol', type=float, default=0.1)
+    args = parser.parse_args()
+    out = Path(args.out)
+    res = run(args.count, tuple(args.size), args.workers)
+    out.mkdir(parents=True, exist_ok=True)
+    # most recent earlier run of the same work
+    prev = args.compare or latest(out, res)
+    # names are unique to the microsecond, never overwrite one anyway
+    name = out / '{}.json'.format(res['meta']['time'].replace(':', ''))
+    with open(name, 'x') as f:
+        f.write(dumps(res, indent=2))
+    print(dumps(res, indent=2))
+    if prev:
+        old = loads(Path(prev).read_text())
+        print('compared to {}:'.format(prev))
+        if comparable(res, old):
+            print('\n'.join(compare(res, old, args.tol)) or 'no regressions')
+        else:
+            print('not comparable, different machines, images or parameters')
+    else:
+        print('no earlier run on this machine, of the same images and '
+            'parameters')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+'''
+Catalog of tetracam image archives, for picking images without listing them
+
+Every image's path, date, plot, size, modification time, dimensions and page
+offsets are kept in a SQLite database, indexed on directory, date and plot.
+Updates only look at files whose size or modification time changed, so keeping
+a large archive current is a directory scan, and selecting a date range or a
+set of plots is an indexed lookup:
+
+update('archive.db', 'flights/2019')
+proc_dir('flights/2019', catalog='archive.db', dates=('10jul2019', '24jul2019'))
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from contextlib import contextmanager
+from json import dumps
+from os import scandir
+from pathlib import Path
+from sqlite3 import connect
+from struct import error as StructError
+
+from pandas import Timestamp, read_sql
+
+from tiff import index
+
+# one row per file, date is iso formatted so it sorts, pages is json with the
+# offsets and byte counts of each page's strips or tiles
+SCHEMA = '''
+create table if not exists images (
+    path text primary key,
+    dir text not null,
+    date text,
+    plot text,
+    size integer not null,
+    mtime integer not null,
+    width integer,
+    height integer,
+    dtype text,
+    pages text);
+create index if not exists images_dir_date_plot on images (dir, date, plot);
+create index if not exists images_date_plot on images (date, plot);
+'''
+
+# columns, in table order
+COLUMNS = ('path', 'dir', 'date', 'plot', 'size', 'mtime', 'width', 'height',
+    'dtype', 'pages')
+
+def update(catalog, path):
+    '''bring the catalog up to date with a directory of images
+
+
+    Parameters
+    ----------
+    catalog : str or pathlib.Path
+        database file, created if needed
+    path : str or pathlib.Path
+        image directory
+
+
+    Returns
+    -------
+    added : int
+        files new or changed since the last update
+    removed : int
+        files no longer in the directory
+
+
+    Notes
+    -----
+    Files are only opened if they're new or their size or modification time
+    changed. Files that aren't tifs or aren't named date_plot are kept with no
+    date, so they aren't looked at again, but never selected.
+    '''
+    path = Path(path).resolve()
+    with _connect(catalog) as db:
+        known = dict(((p, (s, m)) for p, s, m in db.execute(
+            'select path, size, mtime from images where dir = ?',
+            (str(path),))))
+        rows = []
+        seen = set()
+        # scandir hands back stats without another system call per file
+        with scandir(path) as entries:
+            for e in entries:
+                if not e.is_file():
+                    continue
+                stat = e.stat()
+                seen.add(e.path)
+                if known.get(e.path) != (stat.st_size, stat.st_mtime_ns):
+                    rows.append(_row(Path(e.path), stat))
+        gone = [(p,) for p in set(known).difference(seen)]
+        db.executemany('insert or replace into images values ({})'.format(
+            ', '.join('?' * len(COLUMNS))), rows)
+        db.executemany('delete from images where path = ?', gone)
+    return len(rows), len(gone)
+
+def select(catalog, path=None, dates=None, plots=None):
+    '''find images in the catalog
+
+
+    Parameters
+    ----------
+    catalog : str or pathlib.Path
+        database file (see update)
+    path : str or pathlib.Path, optional
+        only images in this directory
+    dates : tuple, optional
+        first and last date (inclusive), anything pandas.Timestamp takes, either
+        can be None
+    plots : iterable of str, optional
+        only these plots
+
+
+    Returns
+    -------
+    list of pathlib.Path
+        in order of date and plot
+    '''
+    where, args = _query(path, dates, plots)
+    with _connect(catalog) as db:
+        res = db.execute('select path from images where {} order by date, '
+            'plot'.format(where), args)
+        return [Path(p) for p, in res]
+
+def read_catalog(catalog, path=None, dates=None, plots=None):
+    '''read catalog entries as a frame, for planning runs
+
+
+    Parameters
+    ----------
+    catalog, path, dates, plots
+        see select
+
+
+    Returns
+    -------
+    DataFrame
+        a row per image, with everything but the page offsets
+    '''
+    where, args = _query(path, dates, plots)
+    cols = ', '.join(c for c in COLUMNS if c != 'pages')
+    with _connect(catalog) as db:
+        df = read_sql('select {} from images where {} order by date, '
+            'plot'.format(cols, where), db, params=args)
+    df['date'] = df['date'].astype('M8[ns]')
+    return df
+
+def parse_name(path):
+    '''extract plot id and date from image name
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+
+
+    Returns
+    -------
+    pandas.Timestamp, str
+    '''
+    date, plot = Path(path).stem.split('_')
+    return Timestamp(date), plot
+
+@contextmanager
+def _connect(catalog):
+    '''open the database, making sure the table exists, commit and close it
+    when done
+    '''
+    db = connect(str(catalog))
+    try:
+        with db:
+            db.executescript(SCHEMA)
+            yield db
+    finally:
+        db.close()
+
+def _query(path, dates, plots):
+    '''build the where clause (and its arguments) of a selection
+    '''
+    where, args = ['date is not null'], []
+    if path is not None:
+        where.append('dir = ?')
+        args.append(str(Path(path).resolve()))
+    start, end = dates or (None, None)
+    # iso strings sort the same as the dates
+    if start is not None:
+        where.append('date >= ?')
+        args.append(Timestamp(start).isoformat())
+    if end is not None:
+        where.append('date <= ?')
+        args.append(Timestamp(end).isoformat())
+    if plots is not None:
+        plots = list(plots)
+        where.append('plot in ({})'.format(', '.join('?' * len(plots))))
+        args.extend(plots)
+    return ' and '.join(where), args
+
+def _row(path, stat):
+    '''catalog row for a file
+    '''
+    try:
+        date, plot = parse_name(path)
+        date = date.isoformat()
+    except ValueError:
+        date = plot = None
+    try:
+        pages = index(path)
+    except (KeyError, StructError, OSError):
+        # not a tif, or not one we can read
+        return (str(path), str(path.parent), None, None, stat.st_size,
+            stat.st_mtime_ns, None, None, None, None)
+    first = pages[0]
+    offsets = dumps([[p.offsets, p.counts] for p in pages])
+    return (str(path), str(path.parent), date, plot, stat.st_size,
+        stat.st_mtime_ns, first.width, first.height, first.dtype.str, offsets)
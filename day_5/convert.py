@@ -0,0 +1,130 @@
+'''
+Converter from raw tetracam images to the layout cover.py expects
+
+Raw images have their bands in RAW order, each page an RGB image with the same
+values in every channel. Converted images have a true monochrome page for each
+band, in BANDS order, uncompressed, so they map straight from disk (see tiff).
+Whole flight directories are converted in parallel, and anything already
+converted is skipped, so a directory can be converted again as images arrive:
+
+python convert.py raw/10jul2019 flights/10jul2019 --nproc 8
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from argparse import ArgumentParser
+from functools import partial
+from os import getpid, replace
+from pathlib import Path
+
+from cover import BANDS, pool_map
+from tiff import read_pages, write_pages
+
+# band order of raw tetracam images
+RAW = ('nir', 'blue', 'green', 'yellow', 'red', 'edge')
+
+def convert_dir(src, dst, nproc=None, order=RAW, tile=None, service=None):
+    '''convert a directory of raw images, skipping those already done
+
+
+    Parameters
+    ----------
+    src : str or pathlib.Path
+        directory of raw images
+    dst : str or pathlib.Path
+        output directory, created if needed
+    nproc : int, optional
+        number of worker processes, defaults to the number of cpus
+    order : tuple of str
+        band order of the raw images
+    tile : int, optional
+        write tiled pages (see tiff.write_pages), for very large images
+    service : cover.Service, optional
+        run on this service's pool (nproc is ignored) instead of starting a
+        new one
+
+
+    Returns
+    -------
+    list of pathlib.Path
+        images converted, in order of completion
+    '''
+    dst = Path(dst)
+    dst.mkdir(parents=True, exist_ok=True)
+    todo = [p for p in sorted(Path(src).iterdir())
+        if p.suffix.lower() in ('.tif', '.tiff')
+        and not converted(p, dst / p.name)]
+    func = partial(convert, dst=dst, order=order, tile=tile)
+    return pool_map(func, todo, nproc, service)
+
+def convert(path, dst, order=RAW, tile=None):
+    '''convert a single raw image
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        raw image
+    dst : str or pathlib.Path
+        output directory, the image keeps its name
+    order, tile
+        see convert_dir
+
+
+    Returns
+    -------
+    pathlib.Path
+        converted image
+
+
+    Notes
+    -----
+    Raw pages are mapped rather than read (see tiff.read_pages), and handed to
+    the writer one at a time, so only a single band is ever copied into
+    memory. The output is written to a temporary name and moved into place, so
+    an interrupted conversion never looks finished.
+    '''
+    path = Path(path)
+    out = Path(dst) / path.name
+    tmp = out.with_name('{}.{}'.format(out.name, getpid()))
+    # first channel of each page, in BANDS order, read as it's written
+    pages = (read_pages(path, [order.index(b)])[0] for b in BANDS)
+    try:
+        write_pages(tmp, pages, tile)
+        replace(tmp, out)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return out
+
+def converted(path, out):
+    '''check whether an image has already been converted
+
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        raw image
+    out : pathlib.Path
+        where the converted image goes
+
+
+    Returns
+    -------
+    bool
+        True if out exists and is no older than the raw image
+    '''
+    return out.exists() and out.stat().st_mtime_ns >= path.stat().st_mtime_ns
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('src', help='directory of raw images')
+    parser.add_argument('dst', help='output directory')
+    parser.add_argument('--nproc', type=int)
+    parser.add_argument('--tile', type=int,
+        help='write tiled pages with tiles this many pixels on a side')
+    args = parser.parse_args()
+    done = convert_dir(args.src, args.dst, args.nproc, tile=args.tile)
+    print('converted {} images'.format(len(done)))
+
+if __name__ == '__main__':
+    main()
@@ -4,122 +4,2072 @@ Image processing module for calculating cover from tetracam images
 Band order is not valid in general -- this is for reformatted images. Bands must
 be conformed to this order, and images must be foramatted as 6-page tifs where
 each page is a band as a true monochrome image (not RGB with identical values).
+Raw images are converted to this layout by convert.py.
 
 contact: cullen.mcgovern@usda.gov
 '''
 
+import ast
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from itertools import chain, islice
+from hashlib import blake2b
+from inspect import signature
+from json import dumps, loads
 from math import ceil, sqrt
-from multiprocessing import Pool
-from os import cpu_count
+from multiprocessing import Pool, get_context
+from multiprocessing.shared_memory import SharedMemory
+from operator import length_hint
+from os import cpu_count, getpid, replace
 from pathlib import Path
 from pdb import set_trace
+from queue import SimpleQueue
+from time import perf_counter, process_time
 
-from PIL import Image, ImageSequence
-from numpy import arange, array, divide, dstack, float32, int16, isfinite, random
-from pandas import Timestamp, DataFrame, concat
-from skimage.filters import threshold_otsu
+from PIL import Image, ImageDraw
+from numpy import add, arange, argmax, array, asarray, bincount, \
+    broadcast_to, clip, concatenate, cumsum, divide, dstack, dtype, empty, \
+    errstate, float16, float32, float64, floor, fromfile, full, int32, intp, \
+    isfinite, linspace, load, nan, nanmean, nanstd, ndarray, ones, packbits, \
+    quantile, random, repeat, savez, stack, take_along_axis, uint8, uint16, \
+    uint32, unique, unpackbits, where, zeros
+from numpy.lib.stride_tricks import sliding_window_view
+from pandas import DataFrame, Index, MultiIndex, Series, Timestamp, concat, \
+    read_pickle
+
+import store
+import tiff
+from catalog import parse_name, select
 
 BANDS = ('nir', 'edge', 'red', 'yellow', 'green', 'blue')
 
-def proc_dir(path):
-    '''process a directory of tetramcam images in a parallel
+# bands used for (fake) ndvi, as nir and red
+NDVI = ('nir', 'red')
+
+# vegetation indices that are normalized differences (a - b) / (a + b) of a
+# pair of bands, see proc_indices
+INDICES = {
+    'ndvi': NDVI,
+    'ndre': ('nir', 'edge'),
+    'gndvi': ('nir', 'green')}
+
+# bands shown as red, green and blue in quicklooks, true and false color (color
+# infrared, where plants are bright red)
+VIEWS = {
+    'rgb': ('red', 'green', 'blue'),
+    'cir': ('nir', 'red', 'green')}
+
+# syntax allowed in index expressions: numbers, bands and the four basic
+# operations (no powers, which can blow up), constants are checked to be
+# numbers in _parse
+SYNTAX = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult,
+    ast.Div, ast.UAdd, ast.USub, ast.Name, ast.Load, ast.Constant)
+
+# number of ndvi histogram bins, evenly spaced over [-1, 1] -- one short of 256
+# so that a bin index fits in a byte with room for NODATA
+BINS = 255
+
+# bin index of nan/inf ndvi (no light in either band)
+NODATA = BINS
+
+# bytes of (float64) ndvi worked on at a time (see ndvi_hist), small enough
+# that each block's temporaries stay in cache
+BLOCK = 1 << 18
+
+# fields of a timing record (see timed)
+TIMING = ('path', 'stage', 'pid', 'bytes', 'wall', 'cpu')
+
+# timing records for this process, a list only while profiling
+_timings = None
+
+# rough memory a worker uses before it touches an image (python, numpy, pandas)
+WORKER_MEMORY = 100 << 20
+
+# one result row, as written to shared memory by workers (see proc_shared),
+# plots get as many characters as the longest image name needs (see _row)
+ROW = dtype([('date', 'M8[ns]'), ('plot', 'U16'), ('rep', 'i8'),
+    ('cc', 'f8')])
+
+# most shared memory (usually /dev/shm) to hold results in, bigger runs collect
+# a frame per image instead (see proc_shared)
+SHARED_MEMORY = 256 << 20
+
+# an image read ahead of processing (see iproc_dir), digest only when caching
+Loaded = namedtuple('Loaded', ('path', 'bands', 'digest'))
+
+def proc_dir(path, threshold='sample', catalog=None, dates=None, plots=None,
+        **kwargs):
+    '''process a directory of tetramcam images in a parallel
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image directory, or an iterable of image paths
+    threshold : {'sample', 'date'}
+        pick an Otsu threshold for every sample, or one for each date from all
+        of its images (see proc_dates)
+    catalog : str or pathlib.Path, optional
+        catalog of the directory (see catalog.update), images are looked up
+        in it rather than listed
+    dates, plots
+        only process images from this date range or these plots, see
+        catalog.select (a catalog is needed)
+    **kwargs
+        passed to iproc_dir (output, caching and scheduling options) and on to
+        proc_img (processing parameters)
+
+    Returns
+    -------
+    DataFrame
+
+
+    Notes
+    -----
+    Unless results are written out or cached as they finish, workers write
+    their rows straight into shared memory and the frame is built once at the
+    end (see proc_shared).
+    '''
+    if catalog is not None:
+        path = select(catalog, path, dates, plots)
+    elif dates is not None or plots is not None:
+        raise ValueError('selecting dates or plots needs a catalog')
+    if threshold == 'date':
+        if kwargs.get('indices'):
+            raise ValueError('per date thresholds are only for ndvi')
+        # results only exist once every image of a date is histogrammed, and
+        # maps would be thresholded per image, not with the date's threshold
+        for k in ('cache', 'batch', 'maps'):
+            if kwargs.get(k) is not None:
+                raise ValueError('per date thresholds can\'t be used with '
+                    '{}'.format(k))
+        return proc_dates(path, **kwargs).sort_index()
+    if threshold != 'sample':
+        raise ValueError('unknown threshold: {!r}'.format(threshold))
+    # shared memory rows only have room for a single cover
+    if kwargs.get('out') is None and kwargs.get('cache') is None \
+            and not kwargs.get('indices'):
+        res = proc_shared(path, **kwargs)
+    else:
+        # collect results in a dataframe
+        res = concat(iproc_dir(path, **kwargs))
+    return res.sort_index()
+
+def proc_shared(path, nproc=None, stats=None, prefetch=0, depth=None,
+        service=None, memory=None, **kwargs):
+    '''process a directory of tetracam images in parallel, collecting results
+    in shared memory
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image directory, or an iterable of image paths
+    nproc, stats, prefetch, depth, service, memory
+        see iproc_dir
+    **kwargs
+        passed to proc_img
+
+
+    Returns
+    -------
+    DataFrame
+        in no particular order
+
+
+    Notes
+    -----
+    A structured array of ROW (with room for the longest plot) with n rows for
+    every image is allocated up front, each image has its own slot, and
+    workers write (date, plot, rep, cc) into it directly. Nothing is pickled
+    back but the batch timings, and there's one DataFrame at the end instead
+    of one per image plus a concat.
+
+    The array, and the frame copied out of it, come out of the memory budget.
+    Runs whose array would be bigger than SHARED_MEMORY go through iproc_dir
+    instead.
+    '''
+    imgs = _images(path)
+    n = _params(kwargs)['n']
+    row = _row(imgs)
+    size = len(imgs) * n * row.itemsize
+    if size > SHARED_MEMORY:
+        return concat(iproc_dir(imgs, nproc=nproc, stats=stats,
+            prefetch=prefetch, depth=depth, service=service, memory=memory,
+            **kwargs))
+    if memory:
+        # the array and the frame copied out of it, in the parent
+        memory -= 2 * size
+        if memory <= 0:
+            raise MemoryError('results need about {:.0f} MB, more than the '
+                'budget'.format(2 * size / 1e6))
+    nproc, slots, depth = _plan(imgs, nproc, prefetch, depth, service, memory,
+        kwargs)
+    # one slot of n rows per image, at least a byte so empty dirs work
+    shm = SharedMemory(create=True, size=max(size, 1))
+    try:
+        items = list(enumerate(imgs))
+        if prefetch and _prefetchable(kwargs):
+            # threads read ahead, see iproc_dir
+            load = partial(_load, bands=kwargs.get('bands', NDVI))
+            items = _prefetch(lambda item: (item[0], load(item[1])), items,
+                prefetch, depth)
+        func = partial(_proc_shared, name=shm.name, shape=(len(imgs), n),
+            row=row, **kwargs)
+        with _pool(service, nproc) as pool:
+            for _ in schedule(pool, func, items, nproc, stats=stats,
+                    slots=slots):
+                pass
+        rows = ndarray((len(imgs) * n,), row, shm.buf)
+        # copies everything out of shared memory
+        df = DataFrame(rows)
+        del rows
+    finally:
+        shm.close()
+        shm.unlink()
+    return df.set_index(['date', 'plot', 'rep'])
+
+def proc_dates(path, out=None, nproc=None, stats=None, prefetch=0, depth=None,
+        service=None, memory=None, **kwargs):
+    '''process a directory of tetracam images in parallel, with one threshold
+    for each date
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image directory, or an iterable of image paths
+    out : str or pathlib.Path, optional
+        results directory (see write_results), written once at the end
+    nproc, stats, prefetch, depth, service, memory
+        see iproc_dir, stats also gets the ndvi threshold of each date
+    **kwargs
+        passed to proc_img
+
+
+    Returns
+    -------
+    DataFrame
+        in no particular order
+
+
+    Notes
+    -----
+    Workers only histogram: each sample window, and the whole image (see
+    hist_img). The image histograms of a date are summed into one, Otsu's
+    method picks its threshold, and every window of the date is classified
+    against it from its histogram, so no image is read twice. Thresholds are
+    less noisy than those of single samples, and cover is comparable across
+    plots.
+
+    A date's threshold depends on all of its images, so results can't be
+    cached per image, and cover maps (which are thresholded as the image is
+    read) can't be made.
+    '''
+    imgs = _images(path)
+    nproc, slots, depth = _plan(imgs, nproc, prefetch, depth, service, memory,
+        kwargs)
+    items = imgs
+    if prefetch and _prefetchable(kwargs):
+        # threads read ahead, see iproc_dir
+        items = _prefetch(partial(_load, bands=kwargs.get('bands', NDVI)),
+            imgs, prefetch, depth)
+    func = partial(_hist_item, **kwargs)
+    with _pool(service, nproc) as pool:
+        res = list(schedule(pool, func, items, nproc, stats=stats,
+            slots=slots))
+    if not res:
+        return _frame(None, [], [], [])
+    dates, plots, h, whole = zip(*res)
+    dates, h = array(dates, 'M8[ns]'), array(h)
+    # merge each date's histograms, then threshold them all at once
+    days, inv = unique(dates, return_inverse=True)
+    merged = zeros((len(days), BINS), intp)
+    add.at(merged, inv, whole)
+    th, _ = otsu_hist(merged)
+    cc = cover_hist(h, th[inv][:, None])
+    df = DataFrame({'date': repeat(dates, h.shape[1]),
+        'plot': repeat(plots, h.shape[1]), 'cc': cc.ravel(),
+        'rep': arange(h.size // BINS) % h.shape[1]})
+    df = df.set_index(['date', 'plot', 'rep'])
+    if stats is not None:
+        # upper edge of each threshold bin, in ndvi
+        stats['thresholds'] = Series(-1 + 2 * (th + 1) / BINS,
+            index=Index(days, name='date'))
+    if out is not None:
+        write_results(df, out)
+    return df
+
+def _hist_item(img, **kwargs):
+    '''histogram one path or Loaded image in a worker (see proc_dates)
+    '''
+    if isinstance(img, Loaded):
+        kwargs.pop('bands', None)
+        date, plot, h, whole = hist_bands(img.path, *img.bands, whole=True,
+            **kwargs)
+    else:
+        date, plot, h, whole = hist_img(img, whole=True, **kwargs)
+    return date.to_datetime64(), plot, h, whole
+
+def _row(imgs):
+    '''ROW, widened so the plot of every image fits
+    '''
+    # a plot is never longer than the name it's taken from
+    n = max((len(p.stem) for p in imgs), default=0)
+    return dtype([(k, 'U{}'.format(max(n, 16)) if k == 'plot' else v)
+        for k, (v, _) in ROW.fields.items()])
+
+def _proc_shared(item, name, shape, row=ROW, **kwargs):
+    '''process one (slot, path or Loaded) item in a worker, writing its rows to
+    shared memory
+    '''
+    i, img = item
+    if isinstance(img, Loaded):
+        kwargs.pop('bands', None)
+        path = img.path
+        date, plot, cc = cover_bands(path, *img.bands, **kwargs)
+    else:
+        path = img
+        date, plot, cc = cover_img(path, **kwargs)
+    with timed('frame', path):
+        shm = SharedMemory(name)
+        try:
+            rows = ndarray(shape, row, shm.buf)[i]
+            rows['date'] = date.to_datetime64()
+            rows['plot'] = plot
+            rows['rep'] = arange(len(cc))
+            rows['cc'] = cc
+            # views have to go before the memory can be closed
+            del rows
+        finally:
+            shm.close()
+
+def iproc_dir(path, out=None, batch=64, cache=None, nproc=None, stats=None,
+        prefetch=0, depth=None, service=None, memory=None, **kwargs):
+    '''process a directory of tetracam images in parallel, yielding results as
+    each image finishes
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image directory, or an iterable of image paths
+    out : str or pathlib.Path, optional
+        results directory (see write_results), results are appended in batches
+    batch : int
+        number of images to collect before each write to out
+    cache : str or pathlib.Path, optional
+        result cache directory (see cached)
+    nproc : int, optional
+        number of worker processes, defaults to the number of cpus
+    stats : dict, optional
+        filled with scheduling statistics and per-stage timings once the run
+        ends (see schedule)
+    prefetch : int
+        number of threads reading images ahead of the workers, 0 to have each
+        worker read its own images
+    depth : int, optional
+        most images read ahead and waiting for a worker when prefetching,
+        defaults to twice nproc
+    service : Service, optional
+        run on this service's pool (nproc is ignored) instead of starting a
+        new one
+    memory : int, optional
+        memory budget in bytes, fewer images are worked on at once if the
+        estimated peak (see peak_memory) of nproc at a time won't fit
+    **kwargs
+        passed to proc_img
+
+
+    Yields
+    ------
+    DataFrame
+        results for a single image, in order of completion
+
+
+    Notes
+    -----
+    Anything already finished is written to out before an error propagates (or
+    the generator is closed), so a crashed run keeps its completed images.
+
+    Prefetching overlaps reading with computing, which helps most when images
+    are on a slow or network disk. Bands are read in the parent's threads and
+    sent to the workers, so memory holds at most depth images plus those being
+    worked on. Tiles and vegetation indices (see proc_img) are read in the
+    workers, never prefetched.
+    '''
+    imgs = _images(path)
+    func = partial(proc_img, **kwargs)
+    hits = ()
+    if cache is not None:
+        # anything unchanged since it was cached never goes to the pool
+        hits = [p for p in imgs if lookup(p, cache, kwargs)]
+        imgs = tuple(set(imgs).difference(hits))
+        func = partial(cached, cache=cache, **kwargs)
+    nproc, slots, depth = _plan(imgs, nproc, prefetch, depth, service, memory,
+        kwargs)
+    if prefetch and _prefetchable(kwargs):
+        # threads read ahead, workers only compute
+        load = partial(_load, bands=kwargs.get('bands', NDVI), cache=cache)
+        imgs = _prefetch(load, imgs, prefetch, depth)
+        func = partial(proc_loaded, cache=cache, **kwargs)
+    # results waiting to be written
+    pending = []
+    with _pool(service, nproc) as pool:
+        try:
+            # small batches handed out on demand, so results arrive as they
+            # finish and no worker sits idle while another has a backlog
+            res = schedule(pool, func, imgs, nproc, stats=stats, slots=slots)
+            for df in chain((cached(p, cache, **kwargs) for p in hits), res):
+                if out is not None:
+                    pending.append(df)
+                    if len(pending) >= batch:
+                        write_results(concat(pending), out)
+                        pending = []
+                yield df
+        finally:
+            if pending:
+                write_results(concat(pending), out)
+
+def _images(path):
+    '''list a directory's images, or take an iterable of them as is
+    '''
+    if isinstance(path, (str, Path)):
+        return tuple(Path(path).iterdir())
+    return tuple(Path(p) for p in path)
+
+def peak_memory(path, prefetch=False, **kwargs):
+    '''estimate the most memory processing an image will take
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    prefetch : bool
+        include a second copy of the bands, read ahead in the parent
+    **kwargs
+        proc_img parameters
+
+
+    Returns
+    -------
+    int
+        bytes, including a worker's own baseline (WORKER_MEMORY)
+
+
+    Notes
+    -----
+    Only the tif headers are read. The estimate counts the bands, the 16 bit
+    lookup index and bin image, and the biggest temporaries of sampling and
+    counting (or the integral histogram), so it's on the high side. Tiled
+    processing only ever holds one tile (see tiled_hist), and raises
+    ValueError for pages that can't be read a tile at a time.
+    '''
+    params = _params(kwargs)
+    page = _source(path).index(path)[BANDS.index(params['bands'][0])]
+    pixels = page.width * page.height
+    band = len(params['bands']) * page.dtype.itemsize
+    if params['tile']:
+        # tiles follow the file's strips or tiles, see tiled_hist
+        ty, tx = _tile_shape(path, page, params['tile'])
+        area = min(ty, page.height) * min(tx, page.width)
+        # a tile of bands, pair index and bins, and the intp copy of a
+        # window's bins that bincount makes
+        res = area * (band + 12) + WORKER_MEMORY
+        if page.compression != 1:
+            # a block is decompressed whole, and undifferenced into a copy
+            tw, tl = page.tile
+            res += tw * min(tl, page.height) * page.spp \
+                * page.dtype.itemsize * (1 + (page.predictor == 2))
+        return int(res)
+    if params['indices']:
+        indices = _indices(params['indices']).values()
+        names = {b for i in indices for b in index_bands(i)}
+        # every band, float32 copies of them and the result for expressions,
+        # the pair index and bins otherwise, then the sample windows
+        expr = any(isinstance(i, str) for i in indices)
+        per = len(names) * (page.dtype.itemsize + 4 * expr) + 4 + 3
+        per += params['n'] * params['frac'] * (4 if expr else 17)
+        return int(pixels * per) + WORKER_MEMORY
+    # bands, then the pair index and bin image
+    per = band * (2 if prefetch else 1) + 3
+    if params['maps'] is not None:
+        # plant and data masks for the cover map
+        per += 2
+    if params['cell']:
+        # cell numbers and offset bin indices, then the int64 histogram of
+        # each cell (with a no data bin) and the int32 integral histogram
+        per += 24 + (8 * (BINS + 1) + 4 * BINS) / params['cell'] ** 2
+    else:
+        # stacked windows, and their offset (intp) bin indices
+        per += params['n'] * params['frac'] * 17
+    return int(pixels * per) + WORKER_MEMORY
+
+def _plan(imgs, nproc, prefetch, depth, service, memory, kwargs):
+    '''work out the number of workers, the most batches to have in flight and
+    the read-ahead depth, keeping within a memory budget if there is one
+    '''
+    nproc = service.nproc if service else nproc or cpu_count()
+    depth = depth or 2 * nproc
+    slots = 2 * nproc
+    if memory and imgs:
+        peak = max(peak_memory(p, bool(prefetch), **kwargs) for p in imgs)
+        cap = int(memory // peak)
+        if cap < 1:
+            # tiles are the way to bring an image's memory down, if it can be
+            # tiled
+            if kwargs.get('tile'):
+                hint = ', try a smaller tile'
+            elif kwargs.get('indices'):
+                hint = ', try fewer indices at a time'
+            else:
+                hint = ', try reading it in tiles (tile=)'
+            raise MemoryError('processing an image needs about {:.0f} MB, '
+                'more than the {:.0f} MB budget{}'.format(peak / 1e6,
+                memory / 1e6, hint))
+        if not service:
+            nproc = min(nproc, cap)
+        # anything handed to a service's pool (or waiting with its bands read)
+        # can be running, so that's what gets capped
+        slots = cap if service or prefetch else 2 * nproc
+        depth = min(depth, cap)
+    return nproc, slots, depth
+
+class Service:
+    '''a long-lived, pre-warmed worker pool for repeated runs
+
+
+    Parameters
+    ----------
+    nproc : int, optional
+        number of worker processes, defaults to the number of cpus
+    method : str
+        multiprocessing start method -- with forkserver (the default), this
+        module and its imports are loaded once in the server process and every
+        worker is forked from it ready to go; use spawn where forkserver isn't
+        available (windows)
+
+
+    Notes
+    -----
+    Starting a pool means importing numpy, pandas and PIL in every worker,
+    which can take longer than processing a small directory. A service pays
+    that once, then reuses its workers for every call until it's closed. Use it
+    as a context manager, or call close when finished:
+
+    >>> with Service() as svc:
+    ...     res = [svc.proc_dir(d) for d in Path('flights').iterdir()]
+    '''
+
+    def __init__(self, nproc=None, method='forkserver'):
+        self.nproc = nproc or cpu_count()
+        ctx = get_context(method)
+        if method == 'forkserver':
+            ctx.set_forkserver_preload([__name__])
+        # workers build their lookup tables as they start, not on first use
+        self.pool = ctx.Pool(self.nproc, initializer=_warm)
+
+    def proc_dir(self, path, **kwargs):
+        '''process a directory on the service's pool, see proc_dir
+        '''
+        return proc_dir(path, service=self, **kwargs)
+
+    def iproc_dir(self, path, **kwargs):
+        '''process a directory on the service's pool, see iproc_dir
+        '''
+        return iproc_dir(path, service=self, **kwargs)
+
+    def close(self):
+        '''shut the workers down once they're finished
+        '''
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _warm():
+    '''get a new worker ready to process images
+    '''
+    ndvi_lut()
+
+@contextmanager
+def _pool(service, nproc):
+    '''the service's pool, or a new one that's closed afterwards
+    '''
+    if service is not None:
+        yield service.pool
+    else:
+        with Pool(nproc) as pool:
+            yield pool
+
+def pool_map(func, items, nproc=None, service=None, stats=None):
+    '''apply a function to items in parallel, for whole-file jobs
+
+
+    Parameters
+    ----------
+    func : callable
+        function of a single item, must be picklable
+    items : iterable
+        items to process
+    nproc : int, optional
+        number of worker processes, defaults to the number of cpus (and is
+        never more than the number of items)
+    service : Service, optional
+        run on this service's pool (nproc is ignored) instead of starting a
+        new one
+    stats : dict, optional
+        scheduling statistics, see schedule
+
+
+    Returns
+    -------
+    list
+        results of func, in order of completion
+
+
+    Notes
+    -----
+    Items are handed out in batches sized on demand (see schedule), and no
+    pool is started when there's nothing to do.
+    '''
+    items = list(items)
+    if not items:
+        return []
+    nproc = service.nproc if service else min(nproc or cpu_count(),
+        len(items))
+    with _pool(service, nproc) as pool:
+        return list(schedule(pool, func, items, nproc, stats=stats))
+
+def schedule(pool, func, items, nproc, target=0.5, stats=None, slots=None):
+    '''apply a function to items on a pool, handing out batches on demand
+
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        worker pool
+    func : callable
+        function of a single item, must be picklable
+    items : iterable
+        items to process
+    nproc : int
+        number of workers in the pool
+    target : float
+        seconds of work to aim for in each batch
+    stats : dict, optional
+        updated with wall time, busy time summed over workers, utilization
+        (busy / (wall * nproc)), busy time per worker process id, the number
+        of batches and the workers' per-stage timing records (see profiling)
+        when the generator finishes
+    slots : int, optional
+        most batches handed to the pool at once, twice nproc by default
+
+
+    Yields
+    ------
+    object
+        results of func, in order of completion
+
+
+    Notes
+    -----
+    Each worker has at most two batches queued at once and takes the next one
+    from the pool's queue as soon as it's done, so a slow image or disk only
+    holds up its own batch. Batch sizes follow the measured time per item,
+    big enough to keep overhead down, and shrink toward the end of the run so
+    that every worker finishes at about the same time.
+
+    Items are only taken from the iterable as batches are handed out. If it
+    has no length, batches are a single item, so a generator feeding the pool
+    (see iproc_dir's prefetch) is never drained faster than it's processed.
+    '''
+    total = length_hint(items)
+    items = iter(items)
+    slots = slots or 2 * nproc
+    done = SimpleQueue()
+    # mean seconds per item, unknown until the first batch comes back
+    lat = None
+    busy = {}
+    timing = []
+    pos = running = batches = 0
+    more = True
+    start = perf_counter()
+    try:
+        while more or running:
+            # top up the queue with batches sized from the latest timings
+            while more and running < slots:
+                left = max(total - pos, 0)
+                size = 1 if lat is None else max(1,
+                    min(int(target / lat), ceil(left / (2 * nproc))))
+                batch = list(islice(items, size))
+                if not batch:
+                    more = False
+                    break
+                pool.apply_async(_run_batch, (func, batch, stats is not None),
+                    callback=done.put, error_callback=done.put)
+                pos += len(batch)
+                running += 1
+                batches += 1
+            if not running:
+                break
+            res = done.get()
+            running -= 1
+            if isinstance(res, BaseException):
+                raise res
+            out, pid, wall, records = res
+            busy[pid] = busy.get(pid, 0) + wall
+            if records:
+                timing.extend(records)
+            # smooth the time per item, images can vary a lot
+            per = wall / len(out)
+            lat = per if lat is None else 0.8 * lat + 0.2 * per
+            yield from out
+    finally:
+        if stats is not None:
+            wall = perf_counter() - start
+            stats.update(wall=wall, busy=sum(busy.values()),
+                utilization=sum(busy.values()) / (wall * nproc) if wall else 0,
+                workers=busy, batches=batches,
+                timing=DataFrame(timing, columns=TIMING))
+
+def _run_batch(func, items, profile=False):
+    '''apply func to a batch of items in a worker, timing the whole batch and
+    optionally each stage of each item (see profiling)
+    '''
+    start = perf_counter()
+    with profiling(profile) as records:
+        res = [func(i) for i in items]
+    return res, getpid(), perf_counter() - start, records
+
+@contextmanager
+def profiling(enabled=True):
+    '''record per-stage timings for everything processed in this process
+
+
+    Parameters
+    ----------
+    enabled : bool
+        record timings, otherwise this does nothing
+
+
+    Yields
+    ------
+    list or None
+        records (see timed), filled in as stages finish -- pass to the
+        DataFrame constructor and report for a summary
+
+
+    Notes
+    -----
+    Pool workers are profiled by passing a stats dict to proc_dir/iproc_dir,
+    which ships their records back with the results as stats['timing'].
+    '''
+    global _timings
+    prev = _timings
+    _timings = [] if enabled else None
+    try:
+        yield _timings
+    finally:
+        _timings = prev
+
+@contextmanager
+def timed(stage, path):
+    '''time a stage of processing an image, if profiling
+
+
+    Parameters
+    ----------
+    stage : str
+        stage name
+    path : str or pathlib.Path
+        image being processed
+
+
+    Yields
+    ------
+    dict
+        the record, with keys TIMING -- set 'bytes' for stages that read data
+
+
+    Notes
+    -----
+    Wall and cpu time are both kept, a stage with much more wall than cpu time
+    is waiting on something (usually the disk). Pages read through memory maps
+    are only pulled from disk as they are used, so most of that wait shows up
+    in ndvi rather than read.
+    '''
+    rec = {'path': str(path), 'stage': stage, 'pid': getpid(), 'bytes': 0}
+    if _timings is None:
+        yield rec
+        return
+    wall, cpu = perf_counter(), process_time()
+    yield rec
+    rec['wall'] = perf_counter() - wall
+    rec['cpu'] = process_time() - cpu
+    _timings.append(rec)
+
+def report(timing):
+    '''summarize per-stage timings
+
+
+    Parameters
+    ----------
+    timing : DataFrame
+        timing records, e.g. stats['timing'] from proc_dir
+
+
+    Returns
+    -------
+    DataFrame
+        for each stage: total wall and cpu seconds, share of the total wall
+        time, mean milliseconds per image and read throughput in MB/s
+    '''
+    g = timing.groupby('stage', sort=False)
+    res = g[['wall', 'cpu', 'bytes']].sum()
+    res['share'] = res['wall'] / res['wall'].sum()
+    res['ms'] = 1000 * res['wall'] / g['path'].nunique()
+    res['MBps'] = res.pop('bytes') / res['wall'] / 1e6
+    return res
+
+def proc_img(path, *, bands=NDVI, n=10, frac=0.1, seed=None, cell=None,
+        tile=None, indices=None, maps=None, block=32, rois=None):
+    '''process a tetracam image file formatted as date_plot[.ext]
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+    bands : tuple of str
+        bands to use as nir and red in ndvi
+    n : int
+        number of samples
+    frac : float
+        fraction of the image covered by each sample
+    seed : int, optional
+        run seed, combined with the image's name to place its samples (see
+        image_rng) -- the same image and seed always get the same windows
+    cell : int, optional
+        sample through an integral histogram with cells of this many pixels on
+        a side (see integral_hist), windows snap to the cell grid -- use this
+        for large numbers of samples
+    tile : int, optional
+        read and histogram the image in tiles of this many pixels on a side
+        (see tiled_hist), so that memory goes with the tile rather than the
+        image -- use this for orthomosaics, cell is ignored
+    indices : iterable or dict, optional
+        vegetation indices to get instead of ndvi cover alone (see
+        proc_indices), bands is ignored, and cell, tile and maps can't be
+        used with them
+    maps : str or pathlib.Path, optional
+        directory to save a cover map of the image to (see cover_map), as
+        <image name>.npz, not for tiles
+    block : int
+        pixels on a side of each block of the cover map
+    rois : dict, optional
+        region of interest of each plot (see roi_mask), samples are drawn
+        within its bounds and pixels outside it are left out of every
+        histogram (and the cover map covers just its bounds), not for tiles
+
+
+    Returns
+    -------
+    DataFrame
+
+
+    Notes
+    -----
+    Every option is passed by keyword, here and on down through cover_img,
+    hist_img and hist_bands, so none can end up in another's place.
+    '''
+    if indices:
+        # indices read whole images, and make no cover map
+        for k, v in (('cell', cell), ('tile', tile), ('maps', maps)):
+            if v:
+                raise ValueError('{} can\'t be used with indices'.format(k))
+        return proc_indices(path, indices, n=n, frac=frac, seed=seed,
+            rois=rois)
+    date, plot, cc = cover_img(path, bands=bands, n=n, frac=frac, seed=seed,
+        cell=cell, tile=tile, maps=maps, block=block, rois=rois)
+    return _frame(path, date, plot, cc)
+
+def _source(path):
+    '''the module that reads an image, store for an image in an array store
+    (a directory), tiff otherwise
+    '''
+    return store if Path(path).is_dir() else tiff
+
+def read_img(path, bands=NDVI, copy=False):
+    '''read bands from a tetracam image
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    bands : tuple of str
+        bands to read
+    copy : bool
+        read the bands into memory now, rather than mapping them (see
+        tiff.read_pages) and reading as they're used
+
+
+    Returns
+    -------
+    list of ndarray
+
+
+    Notes
+    -----
+    path can also be an image in an array store (see store), in which case
+    only the chunks of the bands asked for are read and decompressed.
+    '''
+    # read only the pages we need, mapped straight from the file if possible
+    with timed('read', path) as t:
+        pages = [BANDS.index(b) for b in bands]
+        res = _source(path).read_pages(path, pages)
+        if copy:
+            res = [array(a) for a in res]
+        t['bytes'] = sum(a.nbytes for a in res)
+    return res
+
+def proc_bands(path, nir, red, **kwargs):
+    '''process bands that have already been read from an image
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path the bands were read from, formatted as date_plot[.ext]
+    nir : ndarray
+        nir band
+    red : ndarray
+        red band
+    **kwargs
+        n, frac, seed, cell, maps, block and rois, see proc_img
+
+
+    Returns
+    -------
+    DataFrame
+    '''
+    date, plot, cc = cover_bands(path, nir, red, **kwargs)
+    return _frame(path, date, plot, cc)
+
+def _frame(path, date, plot, cc):
+    '''build the results frame for an image
+    '''
+    # create dataframe with identifiers, assign rep numbers to each sample,
+    # dates in nanoseconds like every other path (see ROW)
+    with timed('frame', path):
+        df = DataFrame({'date': array(date, 'M8[ns]'), 'plot': plot, 'cc': cc,
+            'rep': range(len(cc))})
+        df = df.set_index(['date', 'plot', 'rep'])
+    return df
+
+def cover_img(path, **kwargs):
+    '''get canopy cover for each sample of an image file
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    **kwargs
+        bands, n, frac, seed, cell, tile, maps, block and rois, see proc_img
+
+
+    Returns
+    -------
+    date, plot, cc
+        see cover_bands
+    '''
+    date, plot, h, _ = hist_img(path, **kwargs)
+    # canopy cover for every sample in one batch
+    with timed('otsu', path):
+        _, cc = otsu_hist(h)
+    return date, plot, cc
+
+def hist_img(path, *, bands=NDVI, n=10, frac=0.1, seed=None, cell=None,
+        tile=None, maps=None, block=32, rois=None, whole=False):
+    '''histogram binned ndvi over each sample of an image file
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    bands, n, frac, seed, cell, tile, maps, block, rois
+        see proc_img
+    whole : bool
+        histogram the whole image as well
+
+
+    Returns
+    -------
+    date, plot, h, whole
+        see hist_bands
+    '''
+    if not tile:
+        return hist_bands(path, *read_img(path, bands), n=n, frac=frac,
+            seed=seed, cell=cell, maps=maps, block=block, rois=rois,
+            whole=whole)
+    if maps is not None or rois:
+        raise ValueError('cover maps and rois need the whole image, not tiles')
+    path = Path(path)
+    date, plot = parse_name(path)
+    # windows are drawn just as they are for a whole image, from the header
+    page = _source(path).index(path)[BANDS.index(bands[0])]
+    rng = image_rng(path, seed)
+    s, ys, xs = origins((page.height, page.width), n, frac, rng)
+    rects = stack((ys, xs, ys + s, xs + s), -1)
+    if whole:
+        # the whole image is one more rectangle
+        rects = concatenate((rects, [(0, 0, page.height, page.width)]))
+    h = tiled_hist(path, rects, bands, tile)
+    return (date, plot, h[:-1], h[-1]) if whole else (date, plot, h, None)
+
+def cover_bands(path, nir, red, **kwargs):
+    '''get canopy cover for each sample of an image's bands
+
+
+    Parameters
+    ----------
+    path, nir, red, **kwargs
+        see proc_bands
+
+
+    Returns
+    -------
+    date : pandas.Timestamp
+    plot : str
+    cc : ndarray
+        cover of each sample
+    '''
+    date, plot, h, _ = hist_bands(path, nir, red, **kwargs)
+    # canopy cover for every sample in one batch
+    with timed('otsu', path):
+        _, cc = otsu_hist(h)
+    return date, plot, cc
+
+def hist_bands(path, nir, red, *, n=10, frac=0.1, seed=None, cell=None,
+        maps=None, block=32, rois=None, whole=False):
+    '''histogram binned ndvi over each sample of an image's bands
+
+
+    Parameters
+    ----------
+    path, nir, red
+        see proc_bands
+    n, frac, seed, cell, maps, block, rois
+        see proc_img
+    whole : bool
+        histogram the whole image as well
+
+
+    Returns
+    -------
+    date : pandas.Timestamp
+    plot : str
+    h : ndarray
+        (n, BINS) histogram of each sample
+    whole : ndarray or None
+        histogram of the whole image, if asked for
+    '''
+    path = Path(path)
+    # get image identifiers
+    date, plot = parse_name(path)
+    # get fake ndvi once for entire image, straight to histogram bins
+    roi = rois.get(plot) if rois else None
+    if roi is not None:
+        # nothing outside the roi's bounds is even binned
+        (y0, y1, x0, x1), m = roi_mask(plot, roi, nir.shape)
+        nir, red = nir[y0:y1, x0:x1], red[y0:y1, x0:x1]
+    with timed('ndvi', path):
+        if (whole or maps is not None) and roi is None:
+            # counted as it's binned
+            a, hist = ndvi_hist(nir, red)
+        else:
+            a, hist = ndvi_bins(nir, red), None
+    if roi is not None:
+        with timed('roi', path):
+            # everything outside the roi becomes NODATA, which is all ones
+            a |= m
+            if whole or maps is not None:
+                hist = count(a)
+    if maps is not None:
+        # thresholded on the whole image, while the bins are at hand
+        with timed('map', path):
+            th, _ = otsu_hist(hist)
+            save_map(Path(maps) / (path.stem + '.npz'), cover_map(a, th,
+                block), th, block)
+    rng = image_rng(path, seed)
+    if cell:
+        # window histograms come from four lookups each, not their pixels
+        with timed('histogram', path):
+            ih = integral_hist(a, cell)
+            grid = (ih.shape[0] - 1, ih.shape[1] - 1)
+            h = window_hist(ih, *origins(grid, n, frac, rng))
+    else:
+        with timed('sample', path):
+            s = sample(a, n, frac, rng, stacked=True)
+        with timed('histogram', path):
+            h = count(s)
+    return date, plot, h, hist if whole else None
+
+def roi_mask(plot, roi, shape):
+    '''rasterize a plot's region of interest
+
+
+    Parameters
+    ----------
+    plot : str
+        plot id
+    roi : array_like
+        (y0, x0, y1, x1) rectangle, ends excluded, or a polygon as a sequence
+        of (y, x) vertices, in pixels -- rows first either way
+    shape : tuple of int
+        image dimensions
+
+
+    Returns
+    -------
+    bounds : tuple of int
+        y0, y1, x0, x1 of the roi, within the image
+    mask : ndarray
+        uint8 over the bounds, NODATA outside the roi and 0 inside, so or-ing
+        it into bin indices (see ndvi_bins) drops everything outside
+
+
+    Notes
+    -----
+    Each roi is rasterized once per process for each image geometry and kept
+    as packed bits, and the last few are kept unpacked, so a season of dates
+    of the same plots costs a single in-place or per image.
+    '''
+    return _roi_mask(plot, _roi_key(roi), tuple(shape))
+
+def _roi_key(roi):
+    '''make a roi hashable, a tuple of numbers for rectangles and of (y, x)
+    tuples for polygons
+    '''
+    # numpy and pandas numbers become plain ones
+    roi = asarray(roi).tolist()
+    if isinstance(roi[0], list):
+        return tuple(tuple(v) for v in roi)
+    return tuple(roi)
+
+@lru_cache(maxsize=16)
+def _roi_mask(plot, roi, shape):
+    '''unpack a roi's bits, see roi_mask
+    '''
+    (y0, y1, x0, x1), bits = _roi_bits(plot, roi, shape)
+    m = unpackbits(bits, count=(y1 - y0) * (x1 - x0))
+    m *= NODATA
+    return (y0, y1, x0, x1), m.reshape(y1 - y0, x1 - x0)
+
+@lru_cache(maxsize=None)
+def _roi_bits(plot, roi, shape):
+    '''rasterize a roi as packed bits set outside it, see roi_mask
+    '''
+    h, w = shape
+    if not isinstance(roi[0], tuple):
+        y0, x0, y1, x1 = roi
+        vertices = None
+    else:
+        ys, xs = zip(*roi)
+        y0, x0, y1, x1 = floor(min(ys)), floor(min(xs)), ceil(max(ys)) + 1, \
+            ceil(max(xs)) + 1
+        vertices = roi
+    # bounds within the image
+    y0, x0 = max(int(y0), 0), max(int(x0), 0)
+    y1, x1 = min(int(y1), h), min(int(x1), w)
+    if y1 <= y0 or x1 <= x0:
+        raise ValueError('roi of {} is outside the image'.format(plot))
+    inside = ones((y1 - y0, x1 - x0), bool)
+    if vertices is not None:
+        img = Image.new('1', (x1 - x0, y1 - y0), 0)
+        # PIL takes x first
+        ImageDraw.Draw(img).polygon([(x - x0, y - y0) for y, x in vertices],
+            fill=1)
+        inside = array(img)
+    return (y0, y1, x0, x1), packbits(~inside)
+
+def cover_map(idx, th, block=32):
+    '''reduce binned ndvi to a coarse map of canopy cover
+
+
+    Parameters
+    ----------
+    idx : ndarray
+        bin indices (see ndvi_bins)
+    th : int
+        threshold bin index, bins above it are plant (see otsu_hist)
+    block : int
+        pixels on a side of each block
+
+
+    Returns
+    -------
+    ndarray
+        float16 cover of each block, nan where a block has no data
+
+
+    Notes
+    -----
+    Blocks are summed by reshaping to (rows, block, cols, block), so there's
+    nothing but two boolean images and a sum over the block axes. Blocks on the
+    bottom and right edges are padded out with no data.
+    '''
+    y, x = idx.shape
+    ny, nx = -(-y // block), -(-x // block)
+    plant = zeros((ny * block, nx * block), bool)
+    valid = zeros((ny * block, nx * block), bool)
+    plant[:y, :x] = idx > th
+    # no data is above every threshold
+    valid[:y, :x] = idx != NODATA
+    plant &= valid
+    shape = (ny, block, nx, block)
+    # at most block ** 2 in a block
+    total = valid.reshape(shape).sum((1, 3), dtype=uint32)
+    with errstate(divide='ignore', invalid='ignore'):
+        res = plant.reshape(shape).sum((1, 3), dtype=uint32) / total
+    return res.astype(float16)
+
+def save_map(path, cover, th, block):
+    '''save a cover map (see cover_map)
+
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        file to write, in numpy's npz format
+    cover : ndarray
+        cover of each block
+    th : int
+        threshold bin index the map was made with
+    block : int
+        pixels on a side of each block
+    '''
+    def write(tmp):
+        # savez would add a suffix to a temporary name
+        with open(tmp, 'wb') as f:
+            savez(f, cover=cover, th=th, block=block)
+    _write_atomic(path, write)
+
+def read_map(path):
+    '''read a cover map written by save_map
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        map file
+
+
+    Returns
+    -------
+    cover : ndarray
+        float16 cover of each block
+    ndvi : float
+        threshold, as the upper edge of its bin
+    block : int
+        pixels on a side of each block
+    '''
+    with load(path) as f:
+        return f['cover'], -1 + 2 * (int(f['th']) + 1) / BINS, int(f['block'])
+
+def proc_indices(path, indices=tuple(INDICES), *, n=10, frac=0.1, seed=None,
+        rois=None):
+    '''get several vegetation indices for each sample of an image, reading
+    each band once
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image, formatted as date_plot[.ext]
+    indices : iterable or dict
+        names from INDICES, or {name: index} where an index is a pair of bands
+        (a normalized difference) or an arithmetic expression of bands and
+        numbers, like 'nir / red'
+    n, frac, seed, rois
+        see proc_img
+
+
+    Returns
+    -------
+    DataFrame
+        cover, mean and standard deviation of each index for each sample
+
+
+    Notes
+    -----
+    Every index is evaluated over the same sample windows. Normalized
+    differences are binned like ndvi, so each gets cover from its own Otsu
+    threshold, and its mean and deviation from the sample histograms.
+    Expressions have no fixed range to bin over, so they get the mean and
+    deviation of their finite values, and no cover.
+    '''
+    path = Path(path)
+    date, plot = parse_name(path)
+    indices = _indices(indices)
+    # every band any index needs, read once
+    names = sorted({b for i in indices.values() for b in index_bands(i)},
+        key=BANDS.index)
+    bands = dict(zip(names, read_img(path, names)))
+    roi = rois.get(plot) if rois else None
+    if roi is not None:
+        # every band cut down to the roi's bounds, pixels outside it masked
+        (y0, y1, x0, x1), m = roi_mask(plot, roi, bands[names[0]].shape)
+        bands = {b: a[y0:y1, x0:x1] for b, a in bands.items()}
+    rng = image_rng(path, seed)
+    s, ys, xs = origins(bands[names[0]].shape, n, frac, rng)
+    # bin centers, for stats from histograms
+    x = linspace(-1, 1, BINS + 1)[:-1] + 1 / BINS
+    res = []
+    for name, idx in indices.items():
+        with timed(name, path):
+            if isinstance(idx, str):
+                a = evaluate(idx, bands)
+                if roi is not None:
+                    a[m != 0] = nan
+                w = sliding_window_view(a, (s, s))[ys, xs]
+                w = where(isfinite(w), w, nan)
+                with errstate(invalid='ignore'):
+                    cc, mean, std = full(n, nan), nanmean(w, (1, 2)), \
+                        nanstd(w, (1, 2))
+            else:
+                a = ndvi_bins(*(bands[b] for b in idx))
+                if roi is not None:
+                    a |= m
+                h = count(sliding_window_view(a, (s, s))[ys, xs])
+                _, cc = otsu_hist(h)
+                with errstate(divide='ignore', invalid='ignore'):
+                    mean = (h * x).sum(-1) / h.sum(-1)
+                    std = ((h * (x - mean[:, None]) ** 2).sum(-1)
+                        / h.sum(-1)) ** 0.5
+        res.append(DataFrame({'date': date, 'plot': plot, 'index': name,
+            'rep': range(n), 'cc': cc, 'mean': mean, 'std': std}))
+    with timed('frame', path):
+        df = concat(res).set_index(['date', 'plot', 'index', 'rep'])
+    return df
+
+def index_bands(idx):
+    '''list the bands a vegetation index uses
+
+
+    Parameters
+    ----------
+    idx : tuple or str
+        pair of bands, or an expression (see proc_indices)
+
+
+    Returns
+    -------
+    tuple of str
+    '''
+    if not isinstance(idx, str):
+        return tuple(idx)
+    return tuple(sorted({node.id for node in ast.walk(_parse(idx))
+        if isinstance(node, ast.Name)}, key=BANDS.index))
+
+def evaluate(expr, bands):
+    '''evaluate an index expression over bands
+
+
+    Parameters
+    ----------
+    expr : str
+        arithmetic of band names and numbers, like '(nir - edge) / red'
+    bands : dict
+        array of each band used
+
+
+    Returns
+    -------
+    ndarray
+        float32, nan or inf wherever the expression is undefined
+    '''
+    code = compile(_parse(expr), '<index>', 'eval')
+    # float bands, so differences of unsigned values don't wrap
+    env = {b: bands[b].astype(float32) for b in index_bands(expr)}
+    with errstate(divide='ignore', invalid='ignore'):
+        return asarray(eval(code, {'__builtins__': {}}, env), float32)
+
+@lru_cache(maxsize=None)
+def _parse(expr):
+    '''parse an index expression, allowing only SYNTAX and known bands, and
+    at least one of them
+    '''
+    tree = ast.parse(expr, mode='eval')
+    nodes = list(ast.walk(tree))
+    for node in nodes:
+        if not isinstance(node, SYNTAX) or isinstance(node, ast.Name) \
+                and node.id not in BANDS or isinstance(node, ast.Constant) \
+                and type(node.value) not in (int, float):
+            raise ValueError('bad index expression: {!r}'.format(expr))
+    if not any(isinstance(node, ast.Name) for node in nodes):
+        raise ValueError('bad index expression: {!r} uses no bands'.format(
+            expr))
+    return tree
+
+def _indices(indices):
+    '''normalize indices to {name: pair or expression}
+    '''
+    if isinstance(indices, dict):
+        return dict(indices)
+    return {name: INDICES[name] for name in indices}
+
+def proc_mosaic(path, regions, bands=NDVI, tile=1024):
+    '''get canopy cover of plots in an orthomosaic
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to a 6-page tif (see BANDS), of any size
+    regions : dict
+        (y0, x0, y1, x1) pixel bounds of each plot, ends excluded
+    bands : tuple of str
+        bands to use as nir and red in ndvi
+    tile : int
+        pixels on a side of each tile read (see tiled_hist)
+
+
+    Returns
+    -------
+    DataFrame
+        cover, ndvi threshold and number of pixels with data for each plot
+
+
+    Notes
+    -----
+    Each plot gets its own Otsu threshold, from its histogram summed over
+    every tile it touches.
+    '''
+    path = Path(path)
+    h = tiled_hist(path, list(regions.values()), bands, tile)
+    with timed('otsu', path):
+        th, cc = otsu_hist(h)
+    # upper edge of the threshold bin, in ndvi
+    ndvi = -1 + 2 * (th + 1) / BINS
+    return DataFrame({'cc': cc, 'ndvi': ndvi, 'pixels': h.sum(-1)},
+        index=Index(list(regions), name='plot'))
+
+def tiled_hist(path, rects, bands=NDVI, tile=1024):
+    '''histogram binned ndvi over rectangles of an image, a tile at a time
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    rects : array_like
+        (y0, x0, y1, x1) of each rectangle, ends excluded
+    bands : tuple of str
+        bands to use as nir and red in ndvi
+    tile : int
+        pixels on a side of each tile, rounded to whole tiles of the file
+        (but not uncompressed strips, which can be read in any rows)
+
+
+    Returns
+    -------
+    ndarray
+        (len(rects), BINS) counts
+
+
+    Notes
+    -----
+    Tiles are read with read_window (see tiff and store), binned (see
+    ndvi_bins) and counted into every rectangle they overlap, so peak memory
+    is set by the tile size and nothing is read for tiles that no rectangle
+    touches. Counts are integers, so the histograms are the same as those of
+    the whole image.
+
+    Only uncompressed and deflate compressed pages can be read a tile at a
+    time (see tiff.windowed), anything else (LZW, JPEG, ...) raises
+    ValueError before any is read -- convert those to uncompressed or deflate
+    tiles first. Compressed strips and tiles are decompressed whole, so
+    compressed strips are read the whole width of the image at once (each is
+    decompressed once per band), and pages whose blocks are more than four
+    times the size of a tile raise ValueError too.
+    '''
+    path = Path(path)
+    rects = asarray(rects, intp).reshape(-1, 4)
+    pages = [BANDS.index(b) for b in bands]
+    src = _source(path)
+    page = src.index(path)[pages[0]]
+    ty, tx = _tile_shape(path, page, tile)
+    # one extra bin for no data, dropped at the end
+    h = zeros((len(rects), BINS + 1), intp)
+    for y0 in range(0, page.height, ty):
+        for x0 in range(0, page.width, tx):
+            y1, x1 = min(y0 + ty, page.height), min(x0 + tx, page.width)
+            # rectangles clipped to the tile, in tile coordinates
+            r = clip(rects, (y0, x0, y0, x0), (y1, x1, y1, x1))
+            r -= (y0, x0, y0, x0)
+            hit = ((r[:, 2] > r[:, 0]) & (r[:, 3] > r[:, 1])).nonzero()[0]
+            if not len(hit):
+                continue
+            with timed('read', path) as t:
+                nir, red = (src.read_window(path, p, y0, y1, x0, x1)
+                    for p in pages)
+                t['bytes'] = nir.nbytes + red.nbytes
+            with timed('ndvi', path):
+                a = ndvi_bins(nir, red)
+            with timed('histogram', path):
+                for i in hit:
+                    a0, b0, a1, b1 = r[i]
+                    h[i] += bincount(a[a0:a1, b0:b1].ravel(),
+                        minlength=BINS + 1)
+    return h[:, :BINS]
+
+def _tile_shape(path, page, tile):
+    '''rows and columns of each tile read by tiled_hist, raising ValueError
+    for pages that can't be read a tile at a time
+    '''
+    if not tiff.windowed(page):
+        raise ValueError('{} has compression {} (predictor {}), which can '
+            'only be read whole, so it can\'t be processed in tiles -- '
+            'rewrite it uncompressed or deflate compressed (see '
+            'tiff.write_pages)'.format(path, page.compression,
+            page.predictor))
+    tw, tl = page.tile
+    strips = tw >= page.width
+    if page.compression == 1 and strips:
+        # mapped strips can be read any number of rows at a time
+        return tile, tile
+    if page.compression != 1 and tw * tl > 4 * tile ** 2:
+        # compressed blocks are decompressed whole, however little is used
+        raise ValueError('{} is compressed in blocks of {} x {} pixels, too '
+            'big to read a {} pixel tile at a time -- use a tile of at least '
+            '{}, or rewrite it in smaller tiles (see tiff.write_pages)'.format(
+            path, tw, tl, tile, ceil((tw * tl / 4) ** 0.5)))
+    # line tiles up with the file's own, so none is read (or decompressed)
+    # twice, compressed strips are read whole across
+    ty = max(tile // tl, 1) * tl
+    tx = page.width if strips else max(tile // tw, 1) * tw
+    return ty, tx
+
+def sample(a, n=10, frac=0.1, rng=None, stacked=False):
+    '''take square random samples of the image
+
+
+    Parameters
+    ----------
+    a : ndarray
+        array to sample
+    n : int
+        number of samples
+    frac : float
+        fraction of the image covered by each sample
+    rng : numpy.random.Generator, optional
+        source of sample locations (see image_rng), unseeded by default
+    stacked : bool
+        return all samples as a single (n, s, s) array
+
+
+    Returns
+    -------
+    list or ndarray
+        views of a, or a stack of copies if stacked
+    '''
+    s, ys, xs = origins(a.shape, n, frac, rng)
+    if stacked:
+        # every possible s x s window is a view, pick ours out in one go
+        return sliding_window_view(a, (s, s))[ys, xs]
+    # plain slices are views, nothing is copied
+    return [a[y:y + s, x:x + s] for y, x in zip(ys, xs)]
+
+def origins(shape, n=10, frac=0.1, rng=None):
+    '''choose random square sample windows
+
+
+    Parameters
+    ----------
+    shape : tuple of int
+        image dimensions
+    n : int
+        number of samples
+    frac : float
+        fraction of the image covered by each sample
+    rng : numpy.random.Generator, optional
+        source of sample locations (see image_rng), unseeded by default
+
+
+    Returns
+    -------
+    s : int
+        side length of each window
+    ys, xs : ndarray
+        row and column of the upper left corner of each window
+    '''
+    rng = rng or random.default_rng()
+    s, ys, xs = _origins(array([shape]), frac, rng.random((1, n, 2)))
+    return s[0], ys[0], xs[0]
+
+def batch_origins(paths, n=10, frac=0.1, seed=None, bands=NDVI):
+    '''choose the sample windows of a batch of images, just as processing each
+    of them would (see proc_img)
+
+
+    Parameters
+    ----------
+    paths : iterable of str or pathlib.Path
+        images, only their headers are read
+    n, frac, seed, bands
+        see proc_img
+
+
+    Returns
+    -------
+    s : ndarray
+        side length of each image's windows
+    ys, xs : ndarray
+        (images, n) rows and columns of the upper left corner of each window
+    '''
+    paths = [Path(p) for p in paths]
+    pages = [_source(p).index(p)[BANDS.index(bands[0])] for p in paths]
+    shapes = array([(p.height, p.width) for p in pages]).reshape(-1, 2)
+    # each image's own draws, placed all at once
+    u = array([image_rng(p, seed).random((n, 2)) for p in paths])
+    return _origins(shapes, frac, u.reshape(-1, n, 2))
+
+def _origins(shapes, frac, u):
+    '''place windows in (k, 2) image shapes from (k, n, 2) uniform draws
+    '''
+    # side of each image's squares
+    s = ((frac * shapes.prod(1)) ** 0.5).astype(intp)
+    # keep windows inside the image
+    yx = (u * (shapes - s[:, None])[:, None]).astype(intp)
+    return s, yx[..., 0], yx[..., 1]
+
+def image_rng(path, seed=None):
+    '''random generator for sampling an image
 
 
     Parameters
     ----------
     path : str or pathlib.Path
-        path to image directory
+        image, only its name is used
+    seed : int, optional
+        run seed
+
+
+    Returns
+    -------
+    numpy.random.Generator
+
+
+    Notes
+    -----
+    Generators are seeded from the image's name (date_plot) and the run seed,
+    so the same image gets the same windows whichever worker processes it, in
+    whatever order, and results can be cached and compared across runs. Names
+    survive copying, converting (see convert) and exporting (see store).
+    '''
+    key = blake2b(Path(path).stem.encode(), digest_size=8).digest()
+    entropy = [int.from_bytes(key, 'little')]
+    return random.default_rng(entropy if seed is None else entropy + [seed])
+
+def integral_hist(idx, cell=8, bins=BINS):
+    '''build an integral (summed area) histogram of binned ndvi
+
+
+    Parameters
+    ----------
+    idx : ndarray
+        bin indices (see ndvi_bins), NODATA is ignored
+    cell : int
+        side of the square cells the image is divided into, in pixels
+    bins : int
+        number of bins
+
+
+    Returns
+    -------
+    ndarray
+        (rows + 1, cols + 1, bins) int32 counts, where [i, j] is the histogram
+        of every cell above and to the left of cell (i, j)
+
+
+    Notes
+    -----
+    Any window on the cell grid then has its histogram in O(bins) time (see
+    window_hist), however big it is and however many there are. Pixels past
+    the last whole cell are dropped, and memory is about
+    4 * bins / cell ** 2 bytes per pixel, so cells shouldn't get much smaller
+    than 8.
+    '''
+    rows, cols = idx.shape[0] // cell, idx.shape[1] // cell
+    idx = idx[:rows * cell, :cols * cell]
+    # number each pixel's cell, then count bins within each cell at once
+    cells = (arange(rows * cell) // cell)[:, None] * cols \
+        + (arange(cols * cell) // cell)[None, :]
+    h = bincount((cells * (bins + 1) + idx).ravel(),
+        minlength=rows * cols * (bins + 1))
+    h = h.reshape(rows, cols, bins + 1)[..., :bins]
+    # running totals down and across, with a row and column of zeros in front
+    ih = zeros((rows + 1, cols + 1, bins), int32)
+    ih[1:, 1:] = h
+    # adding a whole row (or column) of histograms at a time is several times
+    # faster than cumsum along the outer axes
+    for i in range(1, rows + 1):
+        ih[i] += ih[i - 1]
+    for j in range(1, cols + 1):
+        ih[:, j] += ih[:, j - 1]
+    return ih
+
+def window_hist(ih, s, ys, xs):
+    '''histograms of square windows from an integral histogram
+
+
+    Parameters
+    ----------
+    ih : ndarray
+        integral histogram (see integral_hist)
+    s : int
+        side of each window, in cells
+    ys, xs : ndarray
+        upper left corner of each window, in cells
+
+
+    Returns
+    -------
+    ndarray
+        (windows, bins) counts
+    '''
+    ys, xs = asarray(ys), asarray(xs)
+    return ih[ys + s, xs + s] - ih[ys, xs + s] - ih[ys + s, xs] + ih[ys, xs]
+
+def bootstrap(df, reps=1000, ci=0.95, seed=None):
+    '''bootstrap the mean canopy cover of each image
+
+
+    Parameters
+    ----------
+    df : DataFrame
+        results from proc_img or proc_dir
+    reps : int
+        number of bootstrap resamples
+    ci : float
+        width of the confidence interval
+    seed : int, optional
+        seed for resampling
+
 
     Returns
     -------
     DataFrame
+        mean, bootstrap standard error and confidence bounds of cover, indexed
+        by date and plot
     '''
-    imgs = tuple(Path(path).iterdir())
-    # get number of processors
-    nproc = cpu_count()
-    # evenly distribute images, with a single process and task per chunk
-    size = ceil(len(imgs) / nproc)
-    with Pool(nproc) as pool:
-        # collect results in a dataframe
-        res = concat(pool.imap_unordered(proc_img, imgs, chunksize=size))
-    return res.sort_index()
+    rng = random.default_rng(seed)
+    keys, res = [], []
+    for key, cc in df['cc'].groupby(level=['date', 'plot']):
+        cc = cc.to_numpy()
+        # resample every rep at once, reps x samples
+        means = cc[rng.integers(0, len(cc), (reps, len(cc)))].mean(1)
+        lo, hi = quantile(means, [(1 - ci) / 2, (1 + ci) / 2])
+        keys.append(key)
+        res.append((cc.mean(), means.std(), lo, hi))
+    return DataFrame(res, columns=['mean', 'se', 'lo', 'hi'],
+        index=MultiIndex.from_tuples(keys, names=['date', 'plot']))
 
-def proc_img(path):
-    '''process a tetracam image file formatted as date_plot[.ext]
+def cached(path, cache, **kwargs):
+    '''process an image, reusing the result of an earlier identical run
 
 
     Parameters
     ----------
     path : str or pathlib.Path
+        path to image
+    cache : str or pathlib.Path
+        cache directory
+    **kwargs
+        passed to proc_img
+
+
+    Returns
+    -------
+    DataFrame
+
+
+    Notes
+    -----
+    Results are keyed on the image's name, a hash of its contents and the
+    processing parameters, so changed images are always processed again. The
+    name is part of the key because the date, plot and sample windows all come
+    from it. The content hash is itself cached on path, size and modification
+    time so unchanged files are only read once.
+    '''
+    res = lookup(path, cache, kwargs)
+    if res is not None:
+        return read_pickle(res)
+    path, cache = Path(path), Path(cache)
+    digest = _remembered(path, cache)
+    if digest is None:
+        # hash the contents, remember it for as long as the file doesn't
+        # change
+        with timed('hash', path) as t:
+            digest = _digest(path)
+            t['bytes'] = path.stat().st_size
+        res = _remember(path, cache, digest, kwargs)
+    else:
+        res = _result(path, cache, digest, kwargs)
+    if res.exists():
+        return read_pickle(res)
+    df = proc_img(path, **kwargs)
+    _write_atomic(res, df.to_pickle)
+    return df
+
+def proc_loaded(img, cache=None, **kwargs):
+    '''process an image that was read ahead of time (see iproc_dir)
+
+
+    Parameters
+    ----------
+    img : Loaded
+        image path, bands and (when caching) content hash
+    cache : str or pathlib.Path, optional
+        result cache directory (see cached)
+    **kwargs
+        proc_img parameters
 
 
     Returns
     -------
     DataFrame
     '''
+    if cache is not None:
+        res = _remember(img.path, Path(cache), img.digest, kwargs)
+        if res.exists():
+            return read_pickle(res)
+    # the bands are already read
+    params = {k: v for k, v in kwargs.items() if k != 'bands'}
+    df = proc_bands(img.path, *img.bands, **params)
+    if cache is not None:
+        _write_atomic(res, df.to_pickle)
+    return df
+
+def _prefetchable(kwargs):
+    '''check whether images can be read ahead for a set of proc_img parameters,
+    tiles are read as they're used and indices read their own bands
+    '''
+    return not kwargs.get('tile') and not kwargs.get('indices')
+
+def _load(path, bands=NDVI, cache=None):
+    '''read an image into memory, for prefetching, with its content hash when
+    caching (hashed only if the cache doesn't know it)
+    '''
     path = Path(path)
-    # get image identifiers
-    date, plot = parse_name(path)
-    # open image in context manager (ensure closure)
-    with Image.open(path) as img:
-        # it's a multipage tif, we want to access bands by index
-        mtif = ImageSequence.Iterator(img)
-        # extract m x n x 2 array
-        nir = array(mtif[BANDS.index('nir')])
-        red = array(mtif[BANDS.index('red')])
-    # get fake ndvi once for entire image
-    a = ndvi(nir, red)
-    # list of canopy cover for each sample
-    cc = [otsu(s) for s in sample(a)]
-    # create dataframe with identifiers, assign rep numbers to each sample
-    df = DataFrame({'date': date, 'plot': plot, 'cc': cc,
-        'rep': range(len(cc))})
-    return df.set_index(['date', 'plot', 'rep'])
+    digest = None
+    if cache is not None:
+        digest = _remembered(path, Path(cache)) or _digest(path)
+    return Loaded(path, read_img(path, bands, copy=True), digest)
+
+def _prefetch(func, items, threads, depth):
+    '''apply func to items on a thread pool, keeping at most depth results
+    waiting, yield results in order
+    '''
+    items = iter(items)
+    with ThreadPoolExecutor(threads) as ex:
+        futs = deque(ex.submit(func, i) for i in islice(items, depth))
+        while futs:
+            res = futs.popleft().result()
+            # replace the one we took, reading stalls while the queue is full
+            futs.extend(ex.submit(func, i) for i in islice(items, 1))
+            yield res
 
-def sample(a):
-    '''take 10 square random samples of 10% of the image each
+def lookup(path, cache, kwargs):
+    '''find the cached result for an image without reading it
 
 
     Parameters
     ----------
-    a : ndarray
-        array to sample
+    path : str or pathlib.Path
+        path to image
+    cache : str or pathlib.Path
+        cache directory
+    kwargs : dict
+        proc_img parameters
 
 
     Returns
     -------
-    list
+    pathlib.Path or None
+        path to the cached result, None if there isn't one
+    '''
+    path, cache = Path(path), Path(cache)
+    digest = _remembered(path, cache)
+    if digest is None:
+        return None
+    res = _result(path, cache, digest, kwargs)
+    return res if res.exists() else None
+
+def _remembered(path, cache):
+    '''the content hash recorded for a file, None unless it's unchanged since
+    '''
+    key = cache / 'files' / _stat_key(path)
+    return key.read_text() if key.exists() else None
+
+def _remember(path, cache, digest, kwargs):
+    '''record a file's content hash, return where its result belongs
+    '''
+    _write_atomic(cache / 'files' / _stat_key(path),
+        lambda p: p.write_text(digest))
+    return _result(path, cache, digest, kwargs)
+
+def _result(path, cache, digest, kwargs):
+    '''where an image's result belongs, for its name, contents and parameters
+    '''
+    return cache / 'results' / '{}-{}-{}.pkl'.format(path.stem, digest,
+        _params_key(kwargs))
+
+def _stat_key(path):
+    '''key a file on its location, size and modification time
+    '''
+    stat = path.stat()
+    key = '{}:{}:{}'.format(path.resolve(), stat.st_size, stat.st_mtime_ns)
+    return blake2b(key.encode(), digest_size=16).hexdigest()
+
+def _params_key(kwargs):
+    '''key a set of proc_img parameters, including defaults
+    '''
+    key = repr(sorted(_params(kwargs).items()))
+    return blake2b(key.encode(), digest_size=8).hexdigest()
+
+def _params(kwargs):
+    '''fill in defaults for a set of proc_img parameters
+    '''
+    params = signature(proc_img).bind(None, **kwargs)
+    params.apply_defaults()
+    del params.arguments['path']
+    return dict(params.arguments)
+
+def _digest(path, size=1 << 20):
+    '''hash the contents of a file, or the meta.json of an image in an array
+    store (which changes whenever it's exported again)
+    '''
+    h = blake2b(digest_size=16)
+    if Path(path).is_dir():
+        path = Path(path) / 'meta.json'
+    with open(path, 'rb') as f:
+        for buf in iter(partial(f.read, size), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+def _write_atomic(path, write):
+    '''write a file so that readers never see it half written, write is called
+    with a temporary path
     '''
-    # original image dimensions
-    y, x = a.shape
-    # dimension of sqare
-    s = int(sqrt(0.1 * y * x))
-    # generate a window of indices over a flattened image
-    idxr = arange(s)[None, :] + x * arange(s)[:, None]
-    # seed indices -- prevent index errors and overflows
-    idxs = random.randint(0, x - s, 10) \
-        + x * random.randint(0, y - s, 10)
-    # flatten to index
-    a = a.flatten()
-    # add each idx to idxr, index image
-    return [a[idxr + idx] for idx in idxs]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('{}.{}'.format(path.name, getpid()))
+    write(tmp)
+    replace(tmp, path)
 
-def parse_name(path):
-    '''extract plot id and date from image name
+def write_results(df, path):
+    '''append results to an on-disk columnar results directory
 
 
     Parameters
     ----------
+    df : DataFrame
+        results, e.g. from proc_img
     path : str or pathlib.Path
-        path to image
+        results directory, created on first write
+
+
+    Notes
+    -----
+    Each column (index levels included) is stored as a flat binary file of
+    fixed-size values, described by meta.json. Appending only ever adds to the
+    end of each file, so an interrupted write costs at most the rows in flight
+    (see read_results). Columns left longer than the others by an interrupted
+    write are cut back before the next append, so rows stay lined up.
+
+    Column types, and the width of strings, are fixed by the first write. A
+    later string that doesn't fit raises ValueError rather than being cut
+    short.
+    '''
+    path = Path(path)
+    meta = path / 'meta.json'
+    names = list(df.index.names)
+    df = df.reset_index()
+    if meta.exists():
+        info = loads(meta.read_text())
+        if set(df.columns) != set(info['dtypes']):
+            raise ValueError('columns {} don\'t match those of {}: {}'.format(
+                list(df.columns), path, list(info['dtypes'])))
+    else:
+        path.mkdir(parents=True, exist_ok=True)
+        info = {'index': names, 'dtypes': {}}
+    # fix column types on the first write, strings get a fixed width
+    for col in df.columns:
+        if col not in info['dtypes']:
+            a = df[col].to_numpy()
+            if a.dtype.kind == 'O':
+                n = max(16, max((len(str(x)) for x in a), default=0))
+                info['dtypes'][col] = '<U{}'.format(n)
+            else:
+                info['dtypes'][col] = a.dtype.str
+    cols = {}
+    for col, dt in info['dtypes'].items():
+        dt = dtype(dt)
+        a = df[col].to_numpy()
+        if dt.kind == 'U' and len(a) and max(len(str(x)) for x in a) \
+                > dt.itemsize // 4:
+            raise ValueError('{!r} values longer than {} characters can\'t be '
+                'added to {}'.format(col, dt.itemsize // 4, path))
+        cols[col] = a.astype(dt)
+    meta.write_text(dumps(info))
+    # rows that made it into every column, anything past them is left from an
+    # interrupted write
+    n = min(_rows(path / col, a.dtype) for col, a in cols.items())
+    for col, a in cols.items():
+        with open(path / col, 'ab') as f:
+            f.truncate(n * a.dtype.itemsize)
+            f.write(a.tobytes())
+
+def read_results(path):
+    '''read a results directory written by write_results
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        results directory
 
 
     Returns
     -------
-    pandas.Timestamp, str
+    DataFrame
     '''
-    date, plot = path.stem.split('_')
-    return Timestamp(date), plot
+    path = Path(path)
+    info = loads((path / 'meta.json').read_text())
+    cols = {}
+    for col, dt in info['dtypes'].items():
+        dt = dtype(dt)
+        cols[col] = fromfile(path / col, dt, _rows(path / col, dt))
+    # drop any rows that didn't make it into every column
+    n = min(len(a) for a in cols.values())
+    df = DataFrame({col: a[:n] for col, a in cols.items()})
+    return df.set_index(info['index'])
+
+def _rows(path, dt):
+    '''count the whole values in a column file, a crash can leave a partial
+    one at the end
+    '''
+    return path.stat().st_size // dt.itemsize if path.exists() else 0
 
 def ndvi(nir, red):
     '''calculate NDVI
@@ -136,10 +2086,135 @@ def ndvi(nir, red):
     Returns
     -------
     numpy.array
+        float32
+    '''
+    if nir.dtype == red.dtype == uint8:
+        # every possible pair of values is already worked out
+        return ndvi_lut()[0].take(_pairs(nir, red))
+    res = empty(nir.shape, float32)
+    ndvi_hist(nir, red, res)
+    return res
+
+def ndvi_hist(nir, red, out=None):
+    '''calculate NDVI bins and their histogram in a single pass
+
+
+    Parameters
+    ----------
+    nir : ndarray
+        nir band
+    red : ndarray
+        red band
+    out : ndarray, optional
+        float32 array to fill with ndvi as well
+
+
+    Returns
+    -------
+    idx : ndarray
+        uint8 bin indices, NODATA where ndvi is undefined (see to_bins)
+    h : ndarray
+        histogram of the whole image over BINS
+
+
+    Notes
+    -----
+    The bands are worked through in blocks of rows (see BLOCK), and each block
+    goes all the way from bands to bins and counts while it's in cache. Only
+    the bin image (and out) are ever full size, rather than a handful of 16 bit
+    and float64 temporaries. 8 bit bands go through the lookup tables (see
+    ndvi_lut), anything else through float64 arithmetic a block at a time, so
+    bins are exactly those of to_bins, and ndvi is stored as float32.
+    '''
+    idx = empty(nir.shape, uint8)
+    # one extra bin for no data, dropped at the end
+    h = zeros(BINS + 1, intp)
+    lut = nir.dtype == red.dtype == uint8 and ndvi_lut()
+    # rows per block, at least one however wide the image
+    rows = max(BLOCK // (8 * nir.shape[-1]), 1)
+    for i in range(0, len(nir), rows):
+        rs = slice(i, i + rows)
+        if lut:
+            # one small index per block feeds both tables
+            pairs = _pairs(nir[rs], red[rs])
+            lut[1].take(pairs, out=idx[rs])
+            if out is not None:
+                lut[0].take(pairs, out=out[rs])
+        else:
+            # block sized temporaries, reused in place from here on
+            a = nir[rs].astype(float64)
+            b = red[rs].astype(float64)
+            d = a - b
+            a += b
+            with errstate(divide='ignore', invalid='ignore'):
+                divide(d, a, out=d)
+            if out is not None:
+                out[rs] = d
+            # straight to bins (see to_bins), nan and inf to NODATA
+            a = d + 1
+            a *= BINS / 2
+            floor(a, out=a)
+            clip(a, 0, BINS - 1, out=a)
+            a[~isfinite(d)] = NODATA
+            idx[rs] = a
+        # count the block while it's still in cache
+        h += bincount(idx[rs].ravel(), minlength=BINS + 1)
+    return idx, h[:BINS]
+
+def ndvi_bins(nir, red):
+    '''calculate NDVI as histogram bin indices (see to_bins)
+
+
+    Parameters
+    ----------
+    nir : ndarray
+        nir band
+    red : ndarray
+        red band
+
+
+    Returns
+    -------
+    numpy.array
+        uint8 bin indices, NODATA where ndvi is undefined
+    '''
+    if nir.dtype == red.dtype == uint8:
+        return ndvi_lut()[1].take(_pairs(nir, red))
+    return ndvi_hist(nir, red)[0]
+
+@lru_cache(maxsize=None)
+def ndvi_lut():
+    '''lookup tables of NDVI for every pair of 8 bit values
+
+
+    Returns
+    -------
+    ndvi : ndarray
+        float32 ndvi, indexed by nir * 256 + red
+    bins : ndarray
+        uint8 histogram bin of each value in ndvi
+
+
+    Notes
+    -----
+    8 bit bands only have 65,536 possible (nir, red) pairs, so NDVI for a
+    whole image is a single lookup rather than a few passes of 16 bit and
+    float64 arithmetic. The tables are built once per process.
+    '''
+    nir, red = divmod(arange(1 << 16), 256)
+    with errstate(divide='ignore', invalid='ignore'):
+        a = (nir - red) / (nir + red)
+    # bin from float64, so values right on a bin edge aren't nudged across it
+    return a.astype(float32), to_bins(a).astype(uint8)
+
+def _pairs(nir, red):
+    '''index into the ndvi lookup tables for 8 bit bands
     '''
-    # must be signed and larger than 255
-    nir, red = nir.astype(int16), red.astype(int16)
-    return (nir - red) / (nir + red)
+    # one 16 bit temporary, built in place
+    idx = nir.astype(uint16)
+    idx <<= 8
+    idx |= red
+    return idx
 
 def otsu(a):
     '''get fractional canopy cover using Otsu's method
@@ -148,20 +2223,154 @@ def otsu(a):
     Parameters
     ----------
     a : ndarray
-        array of ndvi results
+        array of ndvi results, or a stack of them (samples, m, n)
+
+
+    Returns
+    -------
+    float or ndarray
+        cover for a single array, or for each array in a stack
+    '''
+    # nan and inf are left out of the histogram
+    _, cc = otsu_hist(count(to_bins(a)))
+    return cc if a.ndim > 2 else cc.item()
+
+def otsu_hist(h):
+    '''apply Otsu's method to ndvi histograms
+
+
+    Parameters
+    ----------
+    h : ndarray
+        histogram over BINS (see histogram), or any number of them stacked
+        along leading axes
+
+
+    Returns
+    -------
+    th : ndarray
+        threshold for each histogram, as a bin index -- bins above it are plant
+    cc : ndarray
+        fractional canopy cover for each histogram
+
+
+    Notes
+    -----
+    Otsu's method picks the threshold that maximizes the variance between the
+    two classes. With fixed bins that is a couple of cumulative sums and an
+    argmax, no matter how many pixels went into the histogram, and every
+    histogram in a batch is handled at once.
+    '''
+    h = h.astype(float64)
+    bins = h.shape[-1]
+    # bin centers
+    x = linspace(-1, 1, bins + 1)[:-1] + 1 / bins
+    n = h.sum(-1, keepdims=True)
+    # class probability and (unnormalized) mean for each possible threshold
+    with errstate(divide='ignore', invalid='ignore'):
+        w = cumsum(h, -1) / n
+        m = cumsum(h * x, -1) / n
+        var = (m[..., -1:] * w - m) ** 2 / (w * (1 - w))
+    # thresholds that put everything in one class have no variance
+    var = where(isfinite(var), var, 0)
+    th = argmax(var, -1)
+    # everything above the threshold is plant
+    cc = 1 - take_along_axis(w, th[..., None], -1)[..., 0]
+    return th, cc
+
+def cover_hist(h, th):
+    '''get fractional canopy cover of histograms at given thresholds
+
+
+    Parameters
+    ----------
+    h : ndarray
+        histogram over BINS, or any number of them stacked along leading axes
+    th : int or ndarray
+        threshold bin index (see otsu_hist), broadcast against h's leading
+        axes
+
+
+    Returns
+    -------
+    ndarray
+        share of each histogram above its threshold, nan if it's empty
+    '''
+    h = asarray(h)
+    th = broadcast_to(th, h.shape[:-1])
+    w = cumsum(h, -1)
+    with errstate(divide='ignore', invalid='ignore'):
+        return 1 - take_along_axis(w, th[..., None], -1)[..., 0] / w[..., -1]
+
+def histogram(a, bins=BINS):
+    '''histogram ndvi over fixed bins, ignoring nan and inf
+
+
+    Parameters
+    ----------
+    a : ndarray
+        array of ndvi results, or a stack of them along leading axes
+    bins : int
+        number of bins spanning [-1, 1]
+
+
+    Returns
+    -------
+    ndarray
+        counts with shape a.shape[:-2] + (bins,)
+    '''
+    return count(to_bins(a, bins), bins)
+
+def count(idx, bins=BINS):
+    '''histogram ndvi that has already been binned (see to_bins, ndvi_bins)
+
+
+    Parameters
+    ----------
+    idx : ndarray
+        bin indices, or a stack of them along leading axes, with bins marking
+        no data
+    bins : int
+        number of bins
+
+
+    Returns
+    -------
+    ndarray
+        counts with shape idx.shape[:-2] + (bins,)
+    '''
+    lead = idx.shape[:-2]
+    idx = idx.reshape(-1, idx.shape[-2] * idx.shape[-1])
+    k = len(idx)
+    # offset each array's bins so one bincount covers the whole batch, with an
+    # extra bin on the end of each for no data
+    idx = idx + arange(k)[:, None] * (bins + 1)
+    h = bincount(idx.ravel(), minlength=k * (bins + 1))
+    return h.reshape(k, bins + 1)[:, :bins].reshape(lead + (bins,))
+
+def to_bins(a, bins=BINS):
+    '''convert ndvi to histogram bin indices
+
+
+    Parameters
+    ----------
+    a : ndarray
+        ndvi
+    bins : int
+        number of bins spanning [-1, 1]
 
 
     Returns
     -------
-    float
+    ndarray
+        bin indices, with nan and inf set to bins (one past the last bin, NODATA
+        for the default)
     '''
-    a = a[isfinite(a)]
-    # get threshold using otsu's method
-    th = threshold_otsu(a)
-    # pixels greater than the threshold are 1 (true), below are 0
-    return (a > th).sum() / a.size
+    with errstate(invalid='ignore'):
+        idx = clip(floor((a + 1) * (bins / 2)), 0, bins - 1)
+    return where(isfinite(a), idx, bins).astype(intp)
 
-def rgb(path, r='red', g='green', b='blue'):
+def rgb(path, r='red', g='green', b='blue', level=0):
     '''generate an RGB image, optionally reassigning bands
 
 
@@ -175,6 +2384,8 @@ def rgb(path, r='red', g='green', b='blue'):
         band to display as green
     b : str
         band to display as blue
+    level : int
+        pyramid level, the image is shrunk by a factor of 2 ** level
 
 
     Returns
@@ -185,9 +2396,122 @@ def rgb(path, r='red', g='green', b='blue'):
     Notes
     -----
     The returned Image object has all of the methods needed for saving, showing,
-    etc.
+    etc. Bands that aren't 8 bit are scaled down to it.
+    '''
+    bands = [_to_8bit(a) for a in read_img(path, (r, g, b))]
+    img = Image.merge('RGB', [Image.fromarray(a) for a in bands])
+    # box filtered, in C
+    return img.reduce(2 ** level) if level else img
+
+def quicklooks(path, out, levels=3, views=VIEWS, cache=True):
+    '''write downsampled quicklooks of an image at several pyramid levels
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    out : str or pathlib.Path
+        quicklook directory, each image gets a directory of its own named like
+        it, holding <view>_<level>.jpg for each view and level
+    levels : int
+        number of levels, each half the size of the last, starting at half
+        the image's size
+    views : dict
+        bands to show as red, green and blue for each view (see VIEWS)
+    cache : bool
+        skip the image if its quicklooks are from the same contents
+
+
+    Returns
+    -------
+    pathlib.Path
+        the image's quicklook directory
+
+
+    Notes
+    -----
+    Each directory keeps the content hash of the image it was made from (see
+    cached), itself keyed on the image's size and modification time, so an
+    unchanged image isn't read at all and a touched one is only hashed.
+    '''
+    path = Path(path)
+    res = Path(out) / path.stem
+    source = res / 'source.json'
+    key = _stat_key(path)
+    # settings as they come back from json
+    params = loads(dumps({'levels': levels, 'views': views}))
+    info = loads(source.read_text()) if cache and source.exists() else {}
+    digest = None
+    if info and info['params'] == params:
+        if info['stat'] == key:
+            return res
+        # touched but not changed, nothing to redraw
+        digest = _digest(path)
+        if info['digest'] == digest:
+            _write_atomic(source, lambda p: p.write_text(dumps(dict(info,
+                stat=key))))
+            return res
+    res.mkdir(parents=True, exist_ok=True)
+    for view, bands in views.items():
+        # every level is reduced from the one before it
+        img = rgb(path, *bands)
+        for level in range(1, levels + 1):
+            img = img.reduce(2)
+            _write_atomic(res / '{}_{}.jpg'.format(view, level),
+                lambda p: img.save(p, 'JPEG', quality=85))
+    # written last, so an interrupted run is redone
+    _write_atomic(source, lambda p: p.write_text(dumps({'stat': key,
+        'digest': digest or _digest(path), 'params': params})))
+    return res
+
+def _quicklooks_done(path, out, levels=3, views=VIEWS):
+    '''check, without reading the image, whether its quicklooks are current
+    '''
+    source = Path(out) / Path(path).stem / 'source.json'
+    if not source.exists():
+        return False
+    info = loads(source.read_text())
+    return info['stat'] == _stat_key(Path(path)) and info['params'] == loads(
+        dumps({'levels': levels, 'views': views}))
+
+def quicklook_dir(path, out, nproc=None, service=None, **kwargs):
+    '''write quicklooks of a directory of images in parallel
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image directory, or an iterable of image paths
+    out : str or pathlib.Path
+        quicklook directory
+    nproc, service
+        see pool_map
+    **kwargs
+        passed to quicklooks
+
+
+    Returns
+    -------
+    list of pathlib.Path
+        quicklook directories made, in order of completion
+    '''
+    # anything unchanged never goes to the pool
+    imgs = [p for p in _images(path) if not kwargs.get('cache', True)
+        or not _quicklooks_done(p, out, kwargs.get('levels', 3),
+        kwargs.get('views', VIEWS))]
+    return pool_map(partial(quicklooks, out=out, **kwargs), imgs, nproc,
+        service)
+
+def _to_8bit(a):
+    '''scale a band to 8 bits for display
     '''
-    with Image.open(path) as img:
-        mtif = ImageSequence.Iterator(img)
-        return Image.merge(mode='RGB',
-            bands=(mtif[self.BANDS.index(b)] for b in (r, g, b)))
+    if a.dtype == uint8:
+        return a
+    if a.dtype.kind == 'u':
+        # keep the top byte
+        return (a >> (8 * (a.dtype.itemsize - 1))).astype(uint8)
+    # anything else is stretched over its own range
+    a = a.astype(float32)
+    lo, hi = a.min(), a.max()
+    return ((a - lo) * (255 / ((hi - lo) or 1))).astype(uint8)
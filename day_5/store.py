@@ -0,0 +1,260 @@
+'''
+Chunked, compressed array store for images exported from tifs
+
+Each image is a directory named like its tif (date_plot), holding a directory
+of chunks for every page (band) and a meta.json describing them:
+
+store/10jul2019_A11/meta.json
+store/10jul2019_A11/0/0.0
+store/10jul2019_A11/0/0.1
+...
+
+Chunks are square blocks of a page, compressed with zlib (or left raw, which
+are memory mapped), so a band or a window of one is read by decompressing only
+the chunks it touches, with no tif decoding. The reading functions match those
+of tiff, and cover reads images from a store wherever it reads tifs:
+
+export_dir('flights/10jul2019', 'store', nproc=8)
+proc_dir('store', seed=0)
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from functools import lru_cache, partial
+from json import dumps, loads
+from os import getpid, replace
+from pathlib import Path
+from shutil import rmtree
+from zlib import compress, decompress
+
+from numpy import ascontiguousarray, dtype, empty, frombuffer, memmap
+
+from tiff import Page
+from tiff import index as tif_index, read_page as tif_page
+
+def export_dir(src, root, nproc=None, chunk=512, level=1, service=None):
+    '''export a directory of tifs to a store, skipping those already done
+
+
+    Parameters
+    ----------
+    src : str or pathlib.Path
+        directory of tifs
+    root : str or pathlib.Path
+        store directory, created if needed
+    nproc : int, optional
+        number of worker processes, defaults to the number of cpus
+    chunk, level
+        see export
+    service : cover.Service, optional
+        run on this service's pool (nproc is ignored) instead of starting a
+        new one
+
+
+    Returns
+    -------
+    list of pathlib.Path
+        images exported, in order of completion
+    '''
+    # cover reads from stores, so it can only be imported once this module is
+    from cover import pool_map
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    todo = [p for p in sorted(Path(src).iterdir())
+        if p.is_file() and not exported(p, root / p.stem)]
+    func = partial(export, root=root, chunk=chunk, level=level)
+    return pool_map(func, todo, nproc, service)
+
+def export(path, root, chunk=512, level=1):
+    '''export every page of a tif to a store
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        tif to export
+    root : str or pathlib.Path
+        store directory
+    chunk : int
+        pixels on a side of each chunk
+    level : int
+        zlib compression level, 0 to leave chunks raw (and mapped when read)
+
+
+    Returns
+    -------
+    pathlib.Path
+        the image in the store
+    '''
+    path, root = Path(path), Path(root)
+    out = root / path.stem
+    # written next to its final place, then moved there whole
+    tmp = root / '.{}.{}'.format(path.stem, getpid())
+    pages = tif_index(path)
+    stat = path.stat()
+    try:
+        for n in range(len(pages)):
+            # one page in memory at a time
+            a = tif_page(path, n)
+            (tmp / str(n)).mkdir(parents=True)
+            for y in range(0, a.shape[0], chunk):
+                for x in range(0, a.shape[1], chunk):
+                    buf = ascontiguousarray(a[y:y + chunk, x:x + chunk],
+                        a.dtype.newbyteorder('<')).tobytes()
+                    (tmp / str(n) / '{}.{}'.format(y // chunk,
+                        x // chunk)).write_bytes(compress(buf, level)
+                        if level else buf)
+        page = pages[0]
+        meta = {'shape': [page.height, page.width], 'pages': len(pages),
+            'dtype': page.dtype.newbyteorder('<').str, 'chunk': chunk,
+            'compression': 'zlib' if level else None,
+            'source': [str(path.resolve()), stat.st_size, stat.st_mtime_ns]}
+        (tmp / 'meta.json').write_text(dumps(meta))
+        if out.exists():
+            rmtree(out)
+        replace(tmp, out)
+    finally:
+        if tmp.exists():
+            rmtree(tmp)
+    return out
+
+def exported(path, out):
+    '''check whether a tif is already in a store, unchanged
+
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        tif
+    out : pathlib.Path
+        its directory in the store
+
+
+    Returns
+    -------
+    bool
+    '''
+    meta = out / 'meta.json'
+    if not meta.exists():
+        return False
+    stat = path.stat()
+    return loads(meta.read_text())['source'][1:] == [stat.st_size,
+        stat.st_mtime_ns]
+
+def read_pages(path, pages):
+    '''read whole pages of a stored image, see tiff.read_pages
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        image directory in a store
+    pages : iterable of int
+        page numbers (zero based)
+
+
+    Returns
+    -------
+    list of ndarray
+    '''
+    h, w = meta(path)['shape']
+    return [read_window(path, n, 0, h, 0, w) for n in pages]
+
+def read_window(path, n, y0, y1, x0, x1):
+    '''read a rectangle of a single page of a stored image
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        image directory in a store
+    n : int
+        page number (zero based)
+    y0, y1 : int
+        first and one past the last row
+    x0, x1 : int
+        first and one past the last column
+
+
+    Returns
+    -------
+    ndarray
+        a (y1 - y0, x1 - x0) array
+
+
+    Notes
+    -----
+    Only the chunks that overlap the window are read (and decompressed), each
+    straight into its place in the result.
+    '''
+    path = Path(path)
+    info = meta(path)
+    h, w = info['shape']
+    c = info['chunk']
+    dt = dtype(info['dtype'])
+    res = empty((y1 - y0, x1 - x0), dt)
+    for cy in range(y0 // c, -(-y1 // c)):
+        for cx in range(x0 // c, -(-x1 // c)):
+            # edge chunks are only as big as what's left of the page
+            shape = (min(c, h - cy * c), min(c, w - cx * c))
+            name = path / str(n) / '{}.{}'.format(cy, cx)
+            if info['compression']:
+                block = frombuffer(decompress(name.read_bytes()),
+                    dt).reshape(shape)
+            else:
+                block = memmap(name, dt, 'r', shape=shape)
+            # overlap of the chunk and the window, in page coordinates
+            r0, r1 = max(y0, cy * c), min(y1, cy * c + shape[0])
+            c0, c1 = max(x0, cx * c), min(x1, cx * c + shape[1])
+            res[r0 - y0:r1 - y0, c0 - x0:c1 - x0] = block[r0 - cy * c:
+                r1 - cy * c, c0 - cx * c:c1 - cx * c]
+            del block
+    return res
+
+def index(path):
+    '''describe every page of a stored image, see tiff.index
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        image directory in a store
+
+
+    Returns
+    -------
+    tuple of tiff.Page
+        with chunks as tiles, and no offsets
+    '''
+    info = meta(path)
+    h, w = info['shape']
+    c = info['chunk']
+    page = Page(width=w, height=h, dtype=dtype(info['dtype']), spp=1,
+        planar=1, compression=8 if info['compression'] else 1, offsets=(),
+        counts=(), rows=c, tile=(c, c))
+    return (page,) * info['pages']
+
+def meta(path):
+    '''read a stored image's meta.json
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        image directory in a store
+
+
+    Returns
+    -------
+    dict
+        shape, pages, dtype, chunk size, compression and source file (path,
+        size and modification time)
+    '''
+    path = Path(path) / 'meta.json'
+    return _meta(str(path), path.stat().st_mtime_ns)
+
+@lru_cache(maxsize=1024)
+def _meta(path, mtime):
+    '''parse meta.json, cached until it changes
+    '''
+    return loads(Path(path).read_text())
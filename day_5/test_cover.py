@@ -0,0 +1,248 @@
+'''
+Regression checks for cover, against straightforward versions of each step
+
+Otsu's method is checked against skimage, fast ndvi paths against each other
+and plain arithmetic, window histograms against counting the windows, and the
+results directory and result cache against what was written or processed:
+
+python -m unittest test_cover
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from os import utime
+from pathlib import Path
+from shutil import copy
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, skipIf
+
+from numpy import array_equal, concatenate, errstate, float64, isfinite, \
+    random, uint8, uint16
+from pandas import DataFrame, Timestamp, concat
+
+from bench import synth_bands
+from cover import BANDS, BINS, NODATA, cached, count, evaluate, histogram, \
+    index_bands, integral_hist, lookup, ndvi, ndvi_bins, ndvi_hist, otsu, \
+    read_results, tiled_hist, to_bins, window_hist, write_results
+from tiff import write_pages
+
+try:
+    from skimage.filters import threshold_otsu
+except ImportError:
+    threshold_otsu = None
+
+def bands(dtype, shape=(200, 300), seed=0):
+    '''random nir and red bands, with some pixels dark in both
+    '''
+    rng = random.default_rng(seed)
+    top = 256 if dtype == uint8 else 1 << 16
+    nir, red = (rng.integers(0, top, shape).astype(dtype) for _ in range(2))
+    nir[:5, :5] = red[:5, :5] = 0
+    return nir, red
+
+class Otsu(TestCase):
+
+    @skipIf(threshold_otsu is None, 'needs skimage')
+    def test_skimage(self):
+        # soil and plants, well apart
+        rng = random.default_rng(0)
+        a = concatenate([rng.normal(-0.2, 0.08, 60000),
+            rng.normal(0.5, 0.1, 40000)]).clip(-1, 1).reshape(250, 400)
+        expected = (a > threshold_otsu(a, BINS)).mean()
+        self.assertAlmostEqual(otsu(a), expected, 2)
+
+    def test_stack(self):
+        # a stack of samples gets the covers of each sample on its own
+        rng = random.default_rng(1)
+        a = rng.uniform(-1, 1, (4, 50, 60))
+        self.assertTrue(all(otsu(a)[i] == otsu(a[i]) for i in range(4)))
+
+class Ndvi(TestCase):
+
+    def check(self, nir, red):
+        '''compare every ndvi path with float64 arithmetic
+        '''
+        a, b = nir.astype(float64), red.astype(float64)
+        with errstate(divide='ignore', invalid='ignore'):
+            expected = (a - b) / (a + b)
+        bins = to_bins(expected)
+        res = ndvi(nir, red)
+        ok = isfinite(expected)
+        self.assertTrue(array_equal(isfinite(res), ok))
+        self.assertTrue(abs(res[ok] - expected[ok]).max() < 1e-6)
+        self.assertTrue(array_equal(ndvi_bins(nir, red), bins))
+        idx, h = ndvi_hist(nir, red)
+        self.assertTrue(array_equal(idx, bins))
+        self.assertTrue(array_equal(h, histogram(expected)))
+        self.assertTrue(array_equal(h, count(idx)))
+        self.assertEqual((idx == NODATA).sum(), (~ok).sum())
+
+    def test_uint8(self):
+        self.check(*bands(uint8))
+
+    def test_uint16(self):
+        self.check(*bands(uint16))
+
+class Indices(TestCase):
+
+    def test_evaluate(self):
+        nir, red = bands(uint16)
+        a, b = nir.astype(float64), red.astype(float64)
+        res = evaluate('(nir - red) / (nir + 2.5 * red)', {'nir': nir,
+            'red': red})
+        with errstate(divide='ignore', invalid='ignore'):
+            expected = (a - b) / (a + 2.5 * b)
+        ok = isfinite(expected)
+        self.assertTrue(abs(res[ok] - expected[ok]).max() < 1e-6)
+        self.assertEqual(index_bands('red / nir - edge'), ('nir', 'edge',
+            'red'))
+
+    def test_syntax(self):
+        for expr in ('2', 'nir ** 2', "'x' * 10 ** 9", 'nir // red',
+                'True * nir', 'soil - nir', '__import__("os")', 'nir.real'):
+            with self.assertRaises(ValueError, msg=expr):
+                index_bands(expr)
+
+class Windows(TestCase):
+
+    def test_count(self):
+        idx = ndvi_bins(*bands(uint8, (203, 301)))
+        for cell in (1, 4, 8):
+            ih = integral_hist(idx, cell)
+            rng = random.default_rng(cell)
+            s = 5
+            ys = rng.integers(0, ih.shape[0] - s, 20)
+            xs = rng.integers(0, ih.shape[1] - s, 20)
+            h = window_hist(ih, s, ys, xs)
+            for i, (y, x) in enumerate(zip(ys, xs)):
+                w = idx[y * cell:(y + s) * cell, x * cell:(x + s) * cell]
+                self.assertTrue(array_equal(h[i], count(w)))
+
+class Tiles(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = Path(self.tmp.name) / '10jul2019_A11.tif'
+        # plots overlapping each other and the edges of tiles
+        self.rects = [(0, 0, 300, 370), (10, 20, 200, 300), (150, 0, 300, 90)]
+        self.bands = bands(uint8, (300, 370))
+        idx = ndvi_bins(*self.bands)
+        self.expected = [count(idx[y0:y1, x0:x1])
+            for y0, x0, y1, x1 in self.rects]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, **kwargs):
+        '''write the bands as nir and red, the other pages empty
+        '''
+        nir, red = self.bands
+        write_pages(self.path, [{'nir': nir, 'red': red}.get(b, nir * 0)
+            for b in BANDS], **kwargs)
+
+    def check(self, tile):
+        h = tiled_hist(self.path, self.rects, tile=tile)
+        self.assertTrue(array_equal(h, self.expected))
+
+    def test_strip(self):
+        # a single strip is mapped, and read a tile's rows at a time
+        self.write()
+        self.check(64)
+
+    def test_tiles(self):
+        for level in (0, 6):
+            self.write(tile=64, level=level)
+            self.check(100)
+            self.check(32)
+
+    def test_deflate_strip(self):
+        # a single compressed strip has to be decompressed whole, only tiles
+        # big enough to make that worthwhile are allowed
+        self.write(level=6)
+        self.check(256)
+        with self.assertRaises(ValueError):
+            tiled_hist(self.path, self.rects, tile=64)
+
+class Results(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'res'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def frame(self, plot, cc):
+        return DataFrame({'date': Timestamp('2019-07-10'), 'plot': plot,
+            'rep': range(3), 'cc': cc}).set_index(['date', 'plot', 'rep'])
+
+    def test_round_trip(self):
+        a, b = self.frame('A11', 0.1), self.frame('B12', 0.2)
+        write_results(a, self.path)
+        write_results(b, self.path)
+        self.assertTrue(read_results(self.path).equals(concat([a, b])))
+
+    def test_torn(self):
+        a, b = self.frame('A11', 0.1), self.frame('B12', 0.2)
+        write_results(a, self.path)
+        # an interrupted write, two whole values and part of a third
+        with open(self.path / 'date', 'ab') as f:
+            f.write(b'\1' * 19)
+        self.assertTrue(read_results(self.path).equals(a))
+        write_results(b, self.path)
+        self.assertTrue(read_results(self.path).equals(concat([a, b])))
+
+    def test_too_long(self):
+        write_results(self.frame('A11', 0.1), self.path)
+        with self.assertRaises(ValueError):
+            write_results(self.frame('A' * 17, 0.1), self.path)
+
+class Cache(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        self.cache = tmp / 'cache'
+        self.img = tmp / '10jul2019_A11.tif'
+        self.write(0.3)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, cover, mtime=None):
+        '''write a small synthetic image
+        '''
+        rng = random.default_rng(0)
+        b = synth_bands((128, 160), cover, rng)
+        write_pages(self.img, [b[k] for k in BANDS])
+        if mtime is not None:
+            utime(self.img, ns=(mtime, mtime))
+
+    def test_hit(self):
+        self.assertIsNone(lookup(self.img, self.cache, {'seed': 0}))
+        a = cached(self.img, self.cache, seed=0)
+        self.assertIsNotNone(lookup(self.img, self.cache, {'seed': 0}))
+        self.assertTrue(cached(self.img, self.cache, seed=0).equals(a))
+        # other parameters are a miss
+        self.assertIsNone(lookup(self.img, self.cache, {'seed': 1}))
+
+    def test_changed(self):
+        a = cached(self.img, self.cache, seed=0)
+        mtime = self.img.stat().st_mtime_ns
+        self.write(0.7, mtime + 10 ** 9)
+        self.assertIsNone(lookup(self.img, self.cache, {'seed': 0}))
+        b = cached(self.img, self.cache, seed=0)
+        self.assertFalse(b.equals(a))
+        self.assertIsNotNone(lookup(self.img, self.cache, {'seed': 0}))
+
+    def test_copy(self):
+        # a copy under another name is processed, and labeled, as itself
+        a = cached(self.img, self.cache, seed=0)
+        other = copy(self.img, self.img.with_name('24jul2019_Z99.tif'))
+        self.assertIsNone(lookup(other, self.cache, {'seed': 0}))
+        b = cached(other, self.cache, seed=0)
+        self.assertEqual(set(b.index.get_level_values('plot')), {'Z99'})
+        self.assertEqual(set(a.index.get_level_values('plot')), {'A11'})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Round trip checks for tiff, against PIL
+
+Files are written by write_pages or PIL, read back with tiff, and compared
+with what was written and with what PIL reads:
+
+python -m unittest test_tiff
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from PIL import Image
+from numpy import array, array_equal, random, stack, uint8, uint16
+
+from tiff import index, read_page, read_pages, read_window, windowed, \
+    write_pages
+
+# odd sizes, so the last strip or tile is only partly filled
+SHAPE = (300, 370)
+
+# windows to read, (y0, y1, x0, x1), inside a page, across block edges, and
+# the whole page
+WINDOWS = ((10, 20, 30, 40), (60, 250, 5, 365), (0, 300, 0, 370))
+
+def pages(dtype=uint8, count=3, seed=0):
+    '''random pages to write
+    '''
+    rng = random.default_rng(seed)
+    top = 256 if dtype == uint8 else 4096
+    return [rng.integers(0, top, SHAPE).astype(dtype) for _ in range(count)]
+
+def pil_pages(path):
+    '''every page of a tif as read by PIL, first channel only
+    '''
+    res = []
+    with Image.open(path) as img:
+        for n in range(img.n_frames):
+            img.seek(n)
+            res.append(array(img.getchannel(0) if img.mode == 'RGB' else img))
+    return res
+
+class RoundTrip(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'img.tif'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, expected):
+        '''read the file every way there is, and compare with expected and PIL,
+        windows only for pages read_window can read
+        '''
+        self.assertEqual(len(index(self.path)), len(expected))
+        got = read_pages(self.path, range(len(expected)))
+        for n, (a, b, c) in enumerate(zip(expected, got,
+                pil_pages(self.path))):
+            self.assertTrue(array_equal(a, b), 'page {}'.format(n))
+            self.assertTrue(array_equal(a, c), 'page {} (PIL)'.format(n))
+            self.assertTrue(array_equal(a, read_page(self.path, n)))
+            if not windowed(index(self.path)[n]):
+                with self.assertRaises(ValueError):
+                    read_window(self.path, n, *WINDOWS[0])
+                continue
+            for y0, y1, x0, x1 in WINDOWS:
+                self.assertTrue(array_equal(a[y0:y1, x0:x1],
+                    read_window(self.path, n, y0, y1, x0, x1)),
+                    'page {} window {}'.format(n, (y0, y1, x0, x1)))
+
+    def test_strips(self):
+        for dtype in (uint8, uint16):
+            expected = pages(dtype)
+            write_pages(self.path, expected)
+            self.check(expected)
+
+    def test_tiles(self):
+        for dtype in (uint8, uint16):
+            expected = pages(dtype)
+            write_pages(self.path, expected, tile=64)
+            self.assertEqual(index(self.path)[0].tile, (64, 64))
+            self.check(expected)
+
+    def test_deflate_tiles(self):
+        for dtype in (uint8, uint16):
+            expected = pages(dtype)
+            write_pages(self.path, expected, tile=64, level=6)
+            self.assertEqual(index(self.path)[0].compression, 8)
+            self.check(expected)
+
+    def test_deflate_strips(self):
+        # written by libtiff, with and without differencing
+        for predictor in (1, 2):
+            expected = pages(uint16)
+            imgs = [Image.fromarray(a) for a in expected]
+            imgs[0].save(self.path, save_all=True, append_images=imgs[1:],
+                compression='tiff_adobe_deflate',
+                tiffinfo={317: predictor})
+            page = index(self.path)[0]
+            self.assertEqual((page.compression, page.predictor),
+                (8, predictor))
+            self.assertTrue(windowed(page))
+            self.check(expected)
+
+    def test_pil(self):
+        # several strips per page
+        expected = pages()
+        imgs = [Image.fromarray(a) for a in expected]
+        imgs[0].save(self.path, save_all=True, append_images=imgs[1:])
+        self.check(expected)
+
+    def test_lzw(self):
+        expected = pages()
+        imgs = [Image.fromarray(a) for a in expected]
+        imgs[0].save(self.path, save_all=True, append_images=imgs[1:],
+            compression='tiff_lzw')
+        self.assertEqual(index(self.path)[0].compression, 5)
+        self.assertFalse(windowed(index(self.path)[0]))
+        self.check(expected)
+
+    def test_rgb(self):
+        # raw tetracam pages, the same values in every channel
+        expected = pages()
+        imgs = [Image.fromarray(stack([a] * 3, -1)) for a in expected]
+        imgs[0].save(self.path, save_all=True, append_images=imgs[1:])
+        self.assertEqual(index(self.path)[0].spp, 3)
+        self.check(expected)
+
+if __name__ == '__main__':
+    main()
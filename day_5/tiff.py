@@ -0,0 +1,442 @@
+'''
+Minimal reader for pulling individual pages out of multipage tifs
+
+Only the parts of the format that we actually see in tetracam images (and
+the orthomosaics stitched from them) are handled: 8 or 16 bit pages stored as
+strips or tiles, either monochrome or RGB with identical values. Uncompressed
+pages are memory mapped straight from the file, so only the pages (and rows)
+that are touched are ever read from disk, and windows of a page can be read
+without the rest of it (see read_window). Deflate compressed strips and tiles
+are decompressed one at a time for windows, anything else compressed is only
+read whole, through PIL.
+
+Pages are written uncompressed, as a single strip each, which is the layout
+that maps best, or as tiles for images too big to map whole, optionally
+deflate compressed.
+
+contact: cullen.mcgovern@usda.gov
+'''
+
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from struct import calcsize, pack, unpack_from
+from zlib import compress, decompress
+
+from PIL import Image
+from numpy import array, ascontiguousarray, cumsum, dtype, empty, \
+    frombuffer, fromfile, memmap, zeros
+
+# tag ids we care about
+WIDTH = 256
+LENGTH = 257
+BITS = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES = 277
+ROWS = 278
+STRIP_COUNTS = 279
+PLANAR = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_COUNTS = 325
+FORMAT = 339
+
+# struct codes for each tiff field type (byte, ascii, short, long, rational,
+# sbyte, undefined, sshort, slong, srational, float, double, ..., long8)
+TYPES = {1: 'B', 2: 'c', 3: 'H', 4: 'I', 5: 'II', 6: 'b', 7: 'B', 8: 'h',
+    9: 'i', 10: 'ii', 11: 'f', 12: 'd', 16: 'Q', 17: 'q', 18: 'Q'}
+
+# compression tag values read_window decodes a block at a time: none, and
+# deflate (adobe's and the older code)
+WINDOWED = (1, 8, 32946)
+
+# sample format tag values to numpy kinds (uint, int, float)
+KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+# type ids of shorts and longs, for writing
+SHORT, LONG = 3, 4
+
+# everything needed to find a page's pixels in the file, tile is the (width,
+# length) of each block of pixels -- the whole width by rows for strips, and
+# predictor is 2 for blocks compressed as differences along each row
+Page = namedtuple('Page', ('width', 'height', 'dtype', 'spp', 'planar',
+    'compression', 'offsets', 'counts', 'rows', 'tile', 'predictor'),
+    defaults=(1,))
+
+def read_pages(path, pages):
+    '''read pages from a multipage tif as arrays
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    pages : iterable of int
+        page numbers (zero based)
+
+
+    Returns
+    -------
+    list of ndarray
+
+
+    Notes
+    -----
+    Uncompressed pages come back as (read only) memory mapped views of the file,
+    which only touch the disk as they're used. Pages stored as RGB are reduced
+    to their first channel.
+    '''
+    path = Path(path)
+    return [read_page(path, p) for p in pages]
+
+def write_pages(path, pages, tile=None, level=0):
+    '''write arrays as a multipage tif
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    pages : iterable of ndarray
+        2d arrays, one per page (monochrome)
+    tile : int, optional
+        store pages as square tiles of this many pixels on a side (a multiple
+        of 16), rather than a single strip
+    level : int
+        deflate compression level of each strip or tile, 0 to leave them
+        uncompressed (and mapped when read)
+    '''
+    with open(path, 'wb') as f:
+        # little endian header, the first ifd offset is filled in below
+        f.write(b'II*\0' + pack('<I', 0))
+        # position of the offset that should point at the next ifd
+        prev = 4
+        for a in pages:
+            a = ascontiguousarray(a, a.dtype.newbyteorder('<'))
+            kind = {v: k for k, v in KINDS.items()}[a.dtype.kind]
+            entries = [
+                (WIDTH, LONG, (a.shape[1],)),
+                (LENGTH, LONG, (a.shape[0],)),
+                (BITS, SHORT, (a.dtype.itemsize * 8,)),
+                (COMPRESSION, SHORT, (8 if level else 1,)),
+                (PHOTOMETRIC, SHORT, (1,)),
+                (SAMPLES, SHORT, (1,)),
+                (FORMAT, SHORT, (kind,))]
+            if tile:
+                offsets, counts = [], []
+                # edge tiles are padded out to full size
+                for y in range(0, a.shape[0], tile):
+                    for x in range(0, a.shape[1], tile):
+                        t = zeros((tile, tile), a.dtype)
+                        block = a[y:y + tile, x:x + tile]
+                        t[:block.shape[0], :block.shape[1]] = block
+                        buf = t.tobytes()
+                        buf = compress(buf, level) if level else buf
+                        offsets.append(f.tell())
+                        counts.append(len(buf))
+                        f.write(buf)
+                entries += [(TILE_WIDTH, LONG, (tile,)),
+                    (TILE_LENGTH, LONG, (tile,)),
+                    (TILE_OFFSETS, LONG, offsets),
+                    (TILE_COUNTS, LONG, counts)]
+            else:
+                buf = a.tobytes()
+                buf = compress(buf, level) if level else buf
+                entries += [(STRIP_OFFSETS, LONG, (f.tell(),)),
+                    (ROWS, LONG, (a.shape[0],)),
+                    (STRIP_COUNTS, LONG, (len(buf),))]
+                f.write(buf)
+            entries.sort()
+            # values that don't fit in an entry go ahead of the ifd, with the
+            # entry pointing at them
+            fields = []
+            for tag, typ, vals in entries:
+                val = pack('<{}{}'.format(len(vals), TYPES[typ]), *vals)
+                if len(val) > 4:
+                    if f.tell() % 2:
+                        f.write(b'\0')
+                    off = f.tell()
+                    f.write(val)
+                    val = pack('<I', off)
+                # short values sit left justified in the 4 byte value field
+                fields.append(pack('<HHI', tag, typ, len(vals))
+                    + val.ljust(4, b'\0'))
+            # ifds have to start on a word boundary
+            if f.tell() % 2:
+                f.write(b'\0')
+            ifd = f.tell()
+            f.write(pack('<H', len(entries)) + b''.join(fields))
+            f.write(pack('<I', 0))
+            end = f.tell()
+            # link the previous ifd (or the header) to this one
+            f.seek(prev)
+            f.write(pack('<I', ifd))
+            f.seek(end)
+            prev = ifd + 2 + 12 * len(entries)
+
+def read_page(path, n):
+    '''read a single page of a multipage tif
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    n : int
+        page number (zero based)
+
+
+    Returns
+    -------
+    ndarray
+    '''
+    page = index(path)[n]
+    if not windowed(page):
+        return _read_pil(path, n)
+    if page.compression != 1 or page.tile[0] != page.width:
+        # tiles and compressed strips are pieced together, same as any other
+        # window
+        return read_window(path, n, 0, page.height, 0, page.width)
+    offsets, counts, spp = _plane(page)
+    shape = (page.height, page.width, spp)
+    if _contiguous(offsets, counts):
+        # one map over all of the strips
+        a = memmap(path, dtype=page.dtype, mode='r', offset=offsets[0],
+            shape=shape)
+    else:
+        # read each strip straight into its rows of the buffer
+        a = empty(shape, page.dtype)
+        flat = a.reshape(-1)
+        with open(path, 'rb') as f:
+            pos = 0
+            for off, cnt in zip(offsets, counts):
+                f.seek(off)
+                cnt = cnt // page.dtype.itemsize
+                flat[pos:pos + cnt] = fromfile(f, page.dtype, cnt)
+                pos += cnt
+    return a[..., 0]
+
+def read_window(path, n, y0, y1, x0, x1):
+    '''read a rectangle of a single page, without reading the rest of it
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+    n : int
+        page number (zero based)
+    y0, y1 : int
+        first and one past the last row
+    x0, x1 : int
+        first and one past the last column
+
+
+    Returns
+    -------
+    ndarray
+        a (y1 - y0, x1 - x0) copy
+
+
+    Notes
+    -----
+    Only the strips or tiles that overlap the window are mapped, so memory
+    goes with the size of the window rather than the page -- this is what
+    makes orthomosaics tens of thousands of pixels on a side workable. Strips
+    are mapped rather than read, so only the columns touched come off the
+    disk. Deflate compressed blocks are read and decompressed one at a time.
+    Pages with any other compression (LZW, JPEG, ...) can't be read a window
+    at a time and raise ValueError (see windowed), read them whole with
+    read_page or convert them.
+    '''
+    page = index(path)[n]
+    if not windowed(page):
+        raise ValueError('page {} of {} has compression {} (predictor {}), '
+            'which can only be read whole'.format(n, path, page.compression,
+            page.predictor))
+    offsets, counts, spp = _plane(page)
+    tw, tl = page.tile
+    # blocks in each row of blocks (a single one for strips)
+    across = -(-page.width // tw)
+    res = empty((y1 - y0, x1 - x0), page.dtype)
+    for ty in range(y0 // tl, -(-y1 // tl)):
+        for tx in range(x0 // tw, -(-x1 // tw)):
+            i = ty * across + tx
+            t = _block(path, page, offsets[i], counts[i], spp)
+            rows = t.shape[0]
+            # overlap of the block and the window, in page coordinates
+            r0, r1 = max(y0, ty * tl), min(y1, ty * tl + rows)
+            c0, c1 = max(x0, tx * tw), min(x1, (tx + 1) * tw)
+            res[r0 - y0:r1 - y0, c0 - x0:c1 - x0] = t[r0 - ty * tl:r1 - ty * tl,
+                c0 - tx * tw:c1 - tx * tw, 0]
+            del t
+    return res
+
+def windowed(page):
+    '''check whether read_window can read a page a block at a time
+
+
+    Parameters
+    ----------
+    page : Page
+
+
+    Returns
+    -------
+    bool
+        True for uncompressed and deflate compressed pages
+    '''
+    return page.compression in WINDOWED and page.predictor in (1, 2)
+
+def _block(path, page, offset, count, spp):
+    '''a single strip or tile as a (rows, width, samples) array, mapped if
+    it's uncompressed
+    '''
+    tw = page.tile[0]
+    if page.compression == 1:
+        # last strip can be short, tiles are always whole
+        rows = count // (tw * spp * page.dtype.itemsize)
+        return memmap(path, dtype=page.dtype, mode='r', offset=offset,
+            shape=(rows, tw, spp))
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        a = frombuffer(decompress(f.read(count)), page.dtype)
+    a = a.reshape(-1, tw, spp)
+    if page.predictor == 2:
+        # undo the differencing, sums wrap around just as the differences did
+        a = cumsum(a, 1, page.dtype)
+    return a
+
+def index(path):
+    '''locate every page of a tif
+
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path to image
+
+
+    Returns
+    -------
+    tuple of Page
+
+
+    Notes
+    -----
+    The index is cached on path, size and modification time, so a file is only
+    parsed again if it changes.
+    '''
+    path = Path(path)
+    stat = path.stat()
+    return _index(str(path), stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=1024)
+def _index(path, size, mtime):
+    '''parse all image file directories (ifds), see index
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        order = {b'II': '<', b'MM': '>'}[head[:2]]
+        version, = unpack_from(order + 'H', head, 2)
+        # bigtiff uses 8 byte offsets and counts
+        big = version == 43
+        fmt, pos = ('Q', 8) if big else ('I', 4)
+        off, = unpack_from(order + fmt, head, pos)
+        pages = []
+        while off:
+            tags, off = _read_ifd(f, off, order, big)
+            pages.append(_page(tags, order))
+    return tuple(pages)
+
+def _read_ifd(f, off, order, big):
+    '''read one ifd into a {tag: values} dict, return it and the next offset
+    '''
+    # entry count, entry size and offset size differ for bigtiff
+    cnt_fmt, ent_size, off_fmt = ('Q', 20, 'Q') if big else ('H', 12, 'I')
+    f.seek(off)
+    n, = unpack_from(order + cnt_fmt, f.read(8 if big else 2))
+    buf = f.read(n * ent_size + (8 if big else 4))
+    tags = {}
+    for i in range(n):
+        pos = i * ent_size
+        tag, typ = unpack_from(order + 'HH', buf, pos)
+        if typ not in TYPES:
+            continue
+        cnt, = unpack_from(order + ('Q' if big else 'I'), buf, pos + 4)
+        fmt = '{}{}{}'.format(order, cnt * len(TYPES[typ]), TYPES[typ][0])
+        size = calcsize(fmt)
+        # values are stored in the entry if they fit, otherwise at an offset
+        pos += 12 if big else 8
+        if size <= (8 if big else 4):
+            tags[tag] = unpack_from(fmt, buf, pos)
+        else:
+            val, = unpack_from(order + off_fmt, buf, pos)
+            here = f.tell()
+            f.seek(val)
+            tags[tag] = unpack_from(fmt, f.read(size))
+            f.seek(here)
+    nxt, = unpack_from(order + off_fmt, buf, n * ent_size)
+    return tags, nxt
+
+def _page(tags, order):
+    '''build a Page from an ifd's tags
+    '''
+    bits = tags.get(BITS, (1,))[0]
+    kind = KINDS.get(tags.get(FORMAT, (1,))[0], 'u')
+    height = tags[LENGTH][0]
+    width = tags[WIDTH][0]
+    rows = tags.get(ROWS, (height,))[0]
+    if TILE_OFFSETS in tags:
+        return Page(
+            width=width,
+            height=height,
+            dtype=dtype('{}{}{}'.format(order, kind, bits // 8)),
+            spp=tags.get(SAMPLES, (1,))[0],
+            planar=tags.get(PLANAR, (1,))[0],
+            compression=tags.get(COMPRESSION, (1,))[0],
+            offsets=tags[TILE_OFFSETS],
+            counts=tags[TILE_COUNTS],
+            rows=rows,
+            tile=(tags[TILE_WIDTH][0], tags[TILE_LENGTH][0]),
+            predictor=tags.get(PREDICTOR, (1,))[0])
+    return Page(
+        width=width,
+        height=height,
+        dtype=dtype('{}{}{}'.format(order, kind, bits // 8)),
+        spp=tags.get(SAMPLES, (1,))[0],
+        planar=tags.get(PLANAR, (1,))[0],
+        compression=tags.get(COMPRESSION, (1,))[0],
+        offsets=tags.get(STRIP_OFFSETS, ()),
+        counts=tags.get(STRIP_COUNTS, ()),
+        rows=rows,
+        tile=(width, min(rows, height)),
+        predictor=tags.get(PREDICTOR, (1,))[0])
+
+def _plane(page):
+    '''offsets and counts of the blocks holding a page's first sample, and the
+    number of samples interleaved in them
+    '''
+    # planar images store each sample in its own set of blocks
+    k = len(page.offsets) // page.spp if page.planar == 2 else None
+    spp = 1 if page.planar == 2 else page.spp
+    return page.offsets[:k], page.counts[:k], spp
+
+def _contiguous(offsets, counts):
+    '''check whether strips follow one another in the file
+    '''
+    return all(offsets[i] + counts[i] == offsets[i + 1]
+        for i in range(len(offsets) - 1))
+
+def _read_pil(path, n):
+    '''fall back to PIL for pages we can't map directly
+    '''
+    with Image.open(path) as img:
+        img.seek(n)
+        if img.mode in ('RGB', 'RGBA'):
+            img = img.getchannel(0)
+        return array(img)